@@ -0,0 +1,2 @@
+# Benchmark suite: synthetic data generation (datagen), a throwaway local Postgres server (local_postgres) and the
+# runner with its JSON output and comparison mode (run).
@@ -0,0 +1,56 @@
+# Synthetic data for any DBSchema. Tables are filled in foreign key order; a table referenced by others gets
+# 1/fan_out of the rows of the tables pointing at it, and references are skewed so that a few parents own many rows,
+# as directors and movies do.
+import random
+
+
+def get_table_sizes(schema, num_rows, fan_out=10):
+    # Tables nobody references get num_rows rows, each level of referenced tables fan_out times fewer
+    sizes = {}
+    for table_name in reversed(schema.get_table_load_order()):
+        referencing_sizes = [sizes[t] for t in sizes if table_name in schema.tables[t].get_referenced_tables()]
+        if not referencing_sizes:
+            sizes[table_name] = num_rows
+        else:
+            sizes[table_name] = max(1, max(referencing_sizes) // fan_out)
+    return sizes
+
+
+def pick_key(rand, num_keys, skew=1.2):
+    # Pareto distributed key between 1 and num_keys, low keys being the most referenced
+    return min(num_keys, int(rand.paretovariate(skew)))
+
+
+def make_value(rand, table, column_name, row_idx, sizes):
+    column = table.columns[column_name]
+    if 'FOREIGN KEY' in column.type:
+        num_keys = sizes[column.foreign_key['table']]
+        return pick_key(rand, num_keys) if rand.random() < 0.5 else rand.randint(1, num_keys)
+    column_type = column.type[0].upper()
+    if column_type in ('INTEGER', 'INT', 'BIGINT', 'SMALLINT'):
+        if table.unique_columns and column_name in table.unique_columns:
+            return row_idx
+        return rand.randint(1900, 2030)
+    if column_type in ('REAL', 'FLOAT', 'DOUBLE', 'NUMERIC'):
+        return round(rand.uniform(0, 1000), 2)
+    if column_type == 'BOOLEAN':
+        return rand.random() < 0.5
+    # Text values carry the row number, which keeps unique columns unique
+    return '%s %d' % (column_name.replace('_', ' '), row_idx)
+
+
+def iter_table_rows(table, num_rows, sizes, seed=0, start=1):
+    # Rows as lists in the column order the insert statements expect
+    rand = random.Random('%s-%s-%s' % (seed, table.name, start))
+    column_names = table.get_column_names(exclude_index=True)
+    for row_idx in xrange(start, start + num_rows):
+        yield [make_value(rand, table, c, row_idx, sizes) for c in column_names]
+
+
+def load_schema_data(db, num_rows, fan_out=10, seed=0, batch_size=1000):
+    # Fills every table of a freshly created schema; primary keys come out as 1..size in each table
+    sizes = get_table_sizes(db.schema, num_rows, fan_out)
+    for table_name in db.schema.get_table_load_order():
+        rows = iter_table_rows(db.schema.tables[table_name], sizes[table_name], sizes, seed)
+        db.add_table_rows(table_name, rows, batch_size=batch_size)
+    return sizes
@@ -0,0 +1,44 @@
+# Throwaway Postgres server for benchmark runs: initdb into a temporary directory, start it with fsync off on a unix
+# socket only and remove everything again on exit. initdb and pg_ctl are looked up on PATH, then in
+# `pg_config --bindir`.
+import contextlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+
+def find_pg_bin_dir():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path, 'pg_ctl')):
+            return path
+    try:
+        bin_dir = subprocess.check_output(['pg_config', '--bindir']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    if os.path.exists(os.path.join(bin_dir, 'pg_ctl')):
+        return bin_dir
+    return None
+
+
+@contextlib.contextmanager
+def local_postgres(port=54329, db_user='dbmangler'):
+    # Yields the settings for the 'postgres' section of a DB config
+    bin_dir = find_pg_bin_dir()
+    if not bin_dir:
+        raise RuntimeError('initdb/pg_ctl not found, install Postgres or put its bin directory on PATH')
+    tmp_dir = tempfile.mkdtemp(prefix='dbmangler_pg_')
+    data_dir = os.path.join(tmp_dir, 'data')
+    log_file_name = os.path.join(tmp_dir, 'postgres.log')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([os.path.join(bin_dir, 'initdb'), '-D', data_dir, '-U', db_user, '-A', 'trust',
+                               '-E', 'UTF8'], stdout=devnull)
+        subprocess.check_call([os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-l', log_file_name, '-w', 'start',
+                               '-o', "-p %d -k %s -c listen_addresses='' -c fsync=off" % (port, tmp_dir)],
+                              stdout=devnull)
+        try:
+            yield {'db_name': 'postgres', 'db_user': db_user, 'db_password': '', 'host': tmp_dir, 'port': port}
+        finally:
+            subprocess.call([os.path.join(bin_dir, 'pg_ctl'), '-D', data_dir, '-m', 'fast', '-w', 'stop'],
+                            stdout=devnull)
+            shutil.rmtree(tmp_dir)
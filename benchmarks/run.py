@@ -0,0 +1,238 @@
+# Times the core DB paths on synthetic data for any schema config and writes the results as JSON.
+#
+#   python benchmarks/run.py run [--backends sqlite,postgres] [--rows 1000,100000] [--output results.json]
+#   python benchmarks/run.py compare base.json new.json [--threshold 0.1]
+#
+# Postgres runs start a throwaway local server unless --postgres-server config is given, in which case the
+# 'postgres' section of the config is used and its tables are dropped and recreated.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dbmangler_utils
+from benchmarks import datagen
+from benchmarks import local_postgres
+
+CASES = ['add_table_rows', 'add_table_row', 'get_all_table_rows', 'get_subset_table_rows',
+         'get_subset_table_rows_fk', 'update_table_row', 'get_row_insert_if_not_found', 'get_joined_table_rows']
+
+
+def make_db(backend, tmp_dir, db_config, postgres_settings=None):
+    config_file_name = os.path.join(tmp_dir, 'bench_config.json')
+    db_config = dict(db_config)
+    if backend == 'sqlite':
+        import sqlite_db_functions
+        db_config['sqlite'] = {'db_name': os.path.join(tmp_dir, 'bench.db'),
+                               'pragmas': {'synchronous': 'NORMAL', 'cache_size': -65536}}
+        with open(config_file_name, 'w') as data_file:
+            json.dump(db_config, data_file)
+        return sqlite_db_functions.DB(config_file_name)
+    import postgres_db_functions
+    if postgres_settings:
+        db_config['postgres'] = postgres_settings
+    with open(config_file_name, 'w') as data_file:
+        json.dump(db_config, data_file)
+    return postgres_db_functions.DB(config_file_name)
+
+
+def get_stats(latencies, ops=None):
+    latencies = sorted(latencies)
+    seconds = sum(latencies)
+    ops = ops or len(latencies)
+    return {'ops': ops, 'seconds': round(seconds, 6), 'ops_per_sec': round(ops / seconds, 2) if seconds else None,
+            'p50_ms': round(latencies[len(latencies) // 2] * 1000, 4),
+            'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 4)}
+
+
+def time_calls(func, args_list):
+    latencies = []
+    for args in args_list:
+        start = timeit.default_timer()
+        func(*args)
+        latencies.append(timeit.default_timer() - start)
+    return get_stats(latencies)
+
+
+def pick_tables(schema, sizes):
+    # The largest table with foreign keys is the main table, the first table it references is its parent
+    tables = [t for t in schema.get_table_load_order() if schema.tables[t].get_referenced_tables()] or \
+        schema.get_table_load_order()
+    main_table = max(tables, key=lambda t: sizes[t])
+    parent_tables = schema.tables[main_table].get_referenced_tables()
+    return main_table, parent_tables[0] if parent_tables else main_table
+
+
+def make_lookup_data(table, row):
+    # The upsert path takes rows as lists, the select-then-insert path takes condition dicts
+    if table.unique_columns:
+        return row
+    return dict([(c, str(v)) for c, v in zip(table.get_column_names(exclude_index=True), row)])
+
+
+def run_cases(db, sizes, cases, num_ops, seed):
+    rand = random.Random(seed)
+    schema = db.schema
+    main_table, parent_table = pick_tables(schema, sizes)
+    main = schema.tables[main_table]
+    key_column = main.index_columns[0]
+    fk_columns = [c for c in main.columns if 'FOREIGN KEY' in main.columns[c].type]
+    num_ops = min(num_ops, sizes[main_table])
+    results = {}
+
+    if 'get_subset_table_rows' in cases:
+        args_list = [(main_table, [{key_column: rand.randint(1, sizes[main_table])}]) for _ in range(num_ops)]
+        results['get_subset_table_rows'] = time_calls(db.get_subset_table_rows, args_list)
+
+    if 'get_subset_table_rows_fk' in cases and fk_columns:
+        fk_table = main.columns[fk_columns[0]].foreign_key['table']
+        args_list = [(main_table, [{fk_columns[0]: datagen.pick_key(rand, sizes[fk_table])}]) for _ in range(num_ops)]
+        results['get_subset_table_rows_fk'] = time_calls(db.get_subset_table_rows, args_list)
+
+    if 'get_joined_table_rows' in cases and fk_columns:
+        args_list = []
+        for _ in range(max(10, num_ops // 100)):
+            start = rand.randint(1, max(1, sizes[main_table] - 100))
+            rows = db.get_subset_table_rows(main_table, [{key_column: {'BETWEEN': [start, start + 99]}}])
+            args_list.append((main_table, rows))
+        results['get_joined_table_rows'] = time_calls(db.get_joined_table_rows, args_list)
+
+    if 'get_all_table_rows' in cases:
+        # Repeated until about 10^5 rows were read, at least 3 times
+        for table_name in schema.get_table_load_order():
+            args_list = [(table_name,)] * max(3, min(num_ops, 100000 // sizes[table_name]))
+            results['get_all_table_rows[%s]' % table_name] = time_calls(db.get_all_table_rows, args_list)
+
+    if 'update_table_row' in cases:
+        column_names = main.get_column_names(exclude_index=True)
+        new_rows = datagen.iter_table_rows(main, num_ops, sizes, seed + 1, sizes[main_table] + num_ops + 1)
+        args_list = []
+        for key, new_row in zip(rand.sample(xrange(1, sizes[main_table] + 1), num_ops), new_rows):
+            row = db.get_subset_table_rows(main_table, [{key_column: key}])[0]
+            args_list.append((main_table, [row[c] for c in column_names], new_row))
+        results['update_table_row'] = time_calls(db.update_table_row, args_list)
+
+    if 'get_row_insert_if_not_found' in cases:
+        parent = schema.tables[parent_table]
+        existing_rows = list(datagen.iter_table_rows(parent, min(num_ops // 2, sizes[parent_table]), sizes, seed))
+        new_rows = list(datagen.iter_table_rows(parent, num_ops - len(existing_rows), sizes, seed,
+                                                sizes[parent_table] + 2 * num_ops + 1))
+        args_list = [(parent_table, make_lookup_data(parent, r)) for r in existing_rows + new_rows]
+        rand.shuffle(args_list)
+        results['get_row_insert_if_not_found'] = time_calls(db.get_row_insert_if_not_found, args_list)
+
+    if 'add_table_row' in cases:
+        rows = datagen.iter_table_rows(main, num_ops, sizes, seed, sizes[main_table] + 3 * num_ops + 1)
+        results['add_table_row'] = time_calls(db.add_table_row, [(main_table, r) for r in rows])
+
+    return results
+
+
+def run_backend(backend, db_config, num_rows, cases, num_ops, fan_out, seed, postgres_settings=None):
+    tmp_dir = tempfile.mkdtemp(prefix='dbmangler_bench_')
+    try:
+        db = make_db(backend, tmp_dir, db_config, postgres_settings)
+        if backend == 'postgres':
+            db.drop_db_tables()
+        db.create_schema()
+        start = timeit.default_timer()
+        sizes = datagen.load_schema_data(db, num_rows, fan_out, seed)
+        load_seconds = timeit.default_timer() - start
+        results = {}
+        if 'add_table_rows' in cases:
+            results['add_table_rows'] = get_stats([load_seconds], sum(sizes.values()))
+        results.update(run_cases(db, sizes, cases, num_ops, seed))
+        if backend == 'postgres':
+            db.drop_db_tables()
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run(args):
+    db_config = dbmangler_utils.load_config(args.config)
+    cases = args.cases.split(',') if args.cases else CASES
+    output = {'meta': {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': os.path.basename(args.config),
+                       'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+                       'platform': platform.platform(), 'ops': args.ops, 'fan_out': args.fan_out, 'seed': args.seed},
+              'results': []}
+    for backend in args.backends.split(','):
+        for num_rows in [int(float(n)) for n in args.rows.split(',')]:
+            if backend == 'postgres' and args.postgres_server == 'local':
+                with local_postgres.local_postgres() as postgres_settings:
+                    results = run_backend(backend, db_config, num_rows, cases, args.ops, args.fan_out, args.seed,
+                                          postgres_settings)
+            else:
+                results = run_backend(backend, db_config, num_rows, cases, args.ops, args.fan_out, args.seed)
+            for case in sorted(results):
+                result = {'backend': backend, 'rows': num_rows, 'case': case}
+                result.update(results[case])
+                output['results'].append(result)
+                print >> sys.stderr, '%-8s %9d  %-40s %12s ops/s  p99 %8.3f ms' % \
+                    (backend, num_rows, case, results[case]['ops_per_sec'], results[case]['p99_ms'])
+
+    if args.output:
+        with open(args.output, 'w') as data_file:
+            json.dump(output, data_file, indent=2, sort_keys=True)
+    else:
+        print json.dumps(output, indent=2, sort_keys=True)
+
+
+def compare(args):
+    # A case regresses when its throughput drops by more than the threshold fraction
+    with open(args.base) as data_file:
+        base_results = dict([((r['backend'], r['rows'], r['case']), r) for r in json.load(data_file)['results']])
+    with open(args.new) as data_file:
+        new_results = json.load(data_file)['results']
+
+    regressions = []
+    for new_result in new_results:
+        key = (new_result['backend'], new_result['rows'], new_result['case'])
+        if key not in base_results or not base_results[key]['ops_per_sec'] or not new_result['ops_per_sec']:
+            continue
+        change = new_result['ops_per_sec'] / base_results[key]['ops_per_sec'] - 1
+        flag = ''
+        if change < -args.threshold:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        print '%-8s %9d  %-40s %+7.1f%%  %s' % (key + (change * 100, flag))
+
+    print '%d regression(s)' % len(regressions)
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                                             'example_db_config.json'))
+    run_parser.add_argument('--backends', default='sqlite')
+    run_parser.add_argument('--rows', default='1000,10000', help='comma separated, e.g. 1e3,1e5,1e7')
+    run_parser.add_argument('--cases', help='comma separated subset of %s' % ",".join(CASES))
+    run_parser.add_argument('--ops', type=int, default=1000, help='calls timed per case')
+    run_parser.add_argument('--fan-out', type=int, default=10)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--postgres-server', choices=['local', 'config'], default='local')
+    run_parser.add_argument('--output')
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('base')
+    compare_parser.add_argument('new')
+    compare_parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        sys.exit(compare(args))
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
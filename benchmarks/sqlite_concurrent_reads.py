@@ -0,0 +1,85 @@
+# Measures read throughput of the SQLite DB in concurrent mode with N reader threads and one writer thread.
+#
+#   python benchmarks/sqlite_concurrent_reads.py [--rows 100000] [--seconds 3] [--readers 1,2,4,8]
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import sqlite_db_functions
+from benchmarks import datagen
+
+
+def make_config(tmp_dir, base_config_file_name):
+    with open(base_config_file_name) as data_file:
+        db_config = json.load(data_file)
+    db_config['sqlite'] = {'db_name': os.path.join(tmp_dir, 'bench.db'), 'concurrent': True,
+                           'pragmas': {'synchronous': 'NORMAL', 'cache_size': -65536, 'mmap_size': 268435456}}
+    config_file_name = os.path.join(tmp_dir, 'bench_config.json')
+    with open(config_file_name, 'w') as data_file:
+        json.dump(db_config, data_file)
+    return config_file_name
+
+
+def load_data(db, num_rows):
+    return datagen.load_schema_data(db, num_rows, fan_out=100)
+
+
+def run(db, sizes, num_readers, seconds):
+    stop = threading.Event()
+    counts = [0] * num_readers
+    writes = [0]
+
+    def reader(idx):
+        rand = random.Random(idx)
+        while not stop.is_set():
+            db.get_subset_table_rows('movies', [{'movie_id': rand.randint(1, sizes['movies'])}])
+            counts[idx] += 1
+
+    def writer():
+        rows = datagen.iter_table_rows(db.schema.tables['movies'], 10 ** 9, sizes, start=sizes['movies'] + 1)
+        while not stop.is_set():
+            db.add_table_row('movies', next(rows))
+            writes[0] += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(num_readers)]
+    threads.append(threading.Thread(target=writer))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / float(seconds), writes[0] / float(seconds)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                                         'example_db_config.json'))
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--readers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        db = sqlite_db_functions.DB(make_config(tmp_dir, args.config))
+        db.create_schema()
+        sizes = load_data(db, args.rows)
+        print 'readers  reads/s  writes/s'
+        for num_readers in [int(n) for n in args.readers.split(',')]:
+            reads, writes = run(db, sizes, num_readers, args.seconds)
+            print '%7d  %7.0f  %8.0f' % (num_readers, reads, writes)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    main()
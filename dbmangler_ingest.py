@@ -0,0 +1,164 @@
+# Parallel ingest of large CSV or JSON Lines files, in the formats written by export_table. The parent splits the file
+# into chunks of lines, a pool of worker processes parses and encodes the chunks against the table's schema, and the
+# parent writes the encoded batches in input order through the backend's add_encoded_rows as the only writer. At most
+# max_pending chunks are in flight between the file and the writer, so memory stays bounded when the database is
+# slower than the workers.
+import csv
+import itertools
+import multiprocessing
+import threading
+
+import dbmangler_utils
+
+# Set in each worker process by _init_worker
+_worker_encoder = None
+_worker_file_format = None
+
+
+def read_header(fileobj, file_format):
+    # Returns the column names and the remaining lines. CSV columns come from the header line, JSON Lines columns
+    # from the keys of the first object, whose line is handed back with the rest. A first line that cannot be
+    # parsed leaves no columns.
+    if file_format == 'csv':
+        return next(csv.reader([fileobj.readline()]), []), fileobj
+    lines = (line for line in fileobj if line.strip())
+    first_line = next(lines, None)
+    first_row = dbmangler_utils.parse_json_line(first_line) if first_line is not None else None
+    if first_row is None:
+        return [], iter([])
+    return sorted(first_row), itertools.chain([first_line], lines)
+
+
+def iter_line_chunks(lines, file_format, chunk_size):
+    # Chunks of about chunk_size lines. A CSV chunk is extended until its quotes are balanced, so that a quoted value
+    # spanning lines stays in one chunk.
+    chunk = []
+    in_quotes = False
+    for line in lines:
+        chunk.append(line)
+        if file_format == 'csv' and line.count('"') % 2:
+            in_quotes = not in_quotes
+        if len(chunk) >= chunk_size and not in_quotes:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def encode_lines(encoder, file_format, lines):
+    # Returns the encoded rows of a chunk, the number of lines that could not be parsed or encoded and the JSON keys
+    # that are not among the columns, which are left out
+    num_rejected = 0
+    ignored_keys = set()
+    if file_format == 'csv':
+        try:
+            rows = [[None if v == dbmangler_utils.CSV_NULL else v for v in row] for row in csv.reader(lines) if row]
+        except csv.Error as e:
+            print 'ERROR: could not parse CSV chunk for %s: %s' % (encoder.table_name, e)
+            return [], len(lines), ignored_keys
+    else:
+        rows = []
+        for line in lines:
+            if not line.strip():
+                continue
+            row = dbmangler_utils.parse_json_line(line)
+            if row is None:
+                num_rejected += 1
+                continue
+            ignored_keys.update([k for k in row if k not in encoder.column_names])
+            rows.append([row.get(c) for c in encoder.column_names])
+    encoded_rows, num_encode_rejected = encoder.encode_many(rows)
+    return encoded_rows, num_rejected + num_encode_rejected, ignored_keys
+
+
+def _init_worker(config_file_name, table_name, column_names, file_format):
+    # Workers load the schema from its cache file rather than receiving it pickled
+    global _worker_encoder, _worker_file_format
+    schema = dbmangler_utils.load_schema(config_file_name)
+    _worker_encoder = dbmangler_utils.RowEncoder(schema.tables[table_name], column_names)
+    _worker_file_format = file_format
+
+
+def _encode_chunk(lines):
+    return encode_lines(_worker_encoder, _worker_file_format, lines)
+
+
+class BoundedFeed:
+    # Iterated by the pool's task handler thread; each chunk takes a slot that the writer gives back once the chunk
+    # is written, so the file is read at most max_pending chunks ahead of the database
+    def __init__(self, chunks, max_pending):
+        self.chunks = chunks
+        self.slots = threading.Semaphore(max_pending)
+        self.stopped = False
+
+    def __iter__(self):
+        while True:
+            self.slots.acquire()
+            if self.stopped:
+                return
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    def done(self):
+        self.slots.release()
+
+    def stop(self):
+        self.stopped = True
+        self.slots.release()
+
+
+def _write_batches(db, table_name, column_names, batches, transfer, feed=None):
+    failed_batches = []
+    ignored_keys = set()
+    for batch_number, (batch_data, num_rejected, batch_ignored_keys) in enumerate(batches):
+        ignored_keys.update(batch_ignored_keys)
+        if batch_data and not db.add_encoded_rows(table_name, column_names, batch_data):
+            failed_batches.append(batch_number)
+            num_rejected += len(batch_data)
+            batch_data = []
+        transfer.add(len(batch_data), num_rejected)
+        if feed:
+            feed.done()
+    return failed_batches, ignored_keys
+
+
+def ingest_file(db, table_name, fileobj, file_format='csv', processes=None, chunk_size=5000, max_pending=None,
+                progress=None):
+    # Loads a CSV or JSON Lines file into table_name of db, a sqlite or postgres DB. Columns are taken from the file
+    # and may include the primary key. Every chunk is written in its own transaction; a chunk that fails to write is
+    # counted as rejected and listed in failed_batches by its number. With processes=1 the chunks are encoded inline.
+    if table_name not in db.schema.tables or file_format not in dbmangler_utils.EXPORT_FORMATS:
+        return False
+
+    column_names, lines = read_header(fileobj, file_format)
+    if not dbmangler_utils.check_import_columns(db.schema.tables[table_name], column_names):
+        return False
+    processes = processes or multiprocessing.cpu_count()
+    chunks = iter_line_chunks(lines, file_format, chunk_size)
+    transfer = dbmangler_utils.TransferProgress(table_name, progress)
+
+    if processes == 1:
+        encoder = dbmangler_utils.RowEncoder(db.schema.tables[table_name], column_names)
+        batches = (encode_lines(encoder, file_format, c) for c in chunks)
+        failed_batches, ignored_keys = _write_batches(db, table_name, column_names, batches, transfer)
+    else:
+        feed = BoundedFeed(chunks, max_pending or 2 * processes)
+        pool = multiprocessing.Pool(processes, _init_worker,
+                                    (db.schema.config_key[0], table_name, column_names, file_format))
+        try:
+            batches = pool.imap(_encode_chunk, feed)
+            failed_batches, ignored_keys = _write_batches(db, table_name, column_names, batches, transfer, feed)
+        finally:
+            feed.stop()
+            pool.terminate()
+            pool.join()
+
+    if ignored_keys:
+        print 'ERROR: keys %s are missing from the first JSON line and were not loaded into %s' % \
+              (", ".join(sorted(ignored_keys)), table_name)
+    stats = transfer.finish()
+    stats['failed_batches'] = failed_batches
+    stats['ignored_keys'] = sorted(ignored_keys)
+    return stats
@@ -1,5 +1,24 @@
+import base64
+import collections
+import csv
+import functools
+import hashlib
+import itertools
 import json
+import keyword
+import marshal
+import operator
+import os
 import pytoml
+import random
+import re
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 def decode_list(data):
@@ -55,51 +74,1231 @@ def make_list_string_from_char(input_char, length):
     return ret_string
 
 
-class DB:
-    def __init__(self, config_file_name='example_db_config.json'):
-        if config_file_name[-5:] == '.toml':
-            with open(config_file_name) as data_file:
-                db_config = pytoml.load(data_file)
+def make_numbered_placeholders(command, placeholder='?', numbered_format='$%s'):
+    split_command = command.split(placeholder)
+    ret_string = split_command[0]
+    for idx, part in enumerate(split_command[1:]):
+        ret_string += numbered_format % (idx + 1) + part
+    return ret_string
+
+
+TableStatements = collections.namedtuple('TableStatements', ['select', 'insert', 'update', 'delete', 'upsert',
+                                                             'delete_by_key'])
+
+
+def make_key_in_clause(column_names, num_keys, placeholder='?'):
+    if len(column_names) == 1:
+        return "%s IN (%s)" % (column_names[0], make_list_string_from_char(placeholder, num_keys))
+    row_string = "(%s)" % make_list_string_from_char(placeholder, len(column_names))
+    return "(%s) IN (VALUES %s)" % (", ".join(column_names), make_list_string_from_char(row_string, num_keys))
+
+
+def get_included_columns(table, included_columns):
+    # Columns of a joined table named by an included_columns setting; '*' or no setting means all of them
+    if not included_columns or included_columns == '*':
+        return list(table.columns)
+    if isinstance(included_columns, basestring):
+        return [included_columns]
+    return list(included_columns)
+
+
+def make_select_list(schema, table_name, column_names=None, additional_joins=None):
+    # Projection of a select over table_name and its joins: the requested base table columns (all by default) in
+    # table order, then the included_columns of each table joined through a foreign key, then those of each
+    # additional join, set in the base table's joined_tables. Columns are table-qualified. A joined column that only
+    # repeats its join key is left out, and one whose name is already taken is aliased <table>_<column>.
+    table = schema.tables[table_name]
+    for column_name in column_names or []:
+        if column_name not in table.columns:
+            print 'ERROR: unknown column %s in table %s' % (column_name, table_name)
+            return False
+
+    columns = [(table_name, c) for c in column_names or table.columns]
+    for column_name in table.columns:
+        column_info = table.columns[column_name]
+        if 'FOREIGN KEY' in column_info.type:
+            joined_table = schema.tables[column_info.foreign_key['table']]
+            included_columns = get_included_columns(joined_table, column_info.foreign_key.get('included_columns'))
+            columns += [(joined_table.name, c) for c in included_columns if c != column_name]
+    for j in additional_joins or []:
+        if j['joined_table'] not in schema.tables:
+            columns.append((j['joined_table'], '*'))
+            continue
+        joined_table_def = getattr(table, 'joined_tables', {}).get(j['joined_table'])
+        included_columns = get_included_columns(schema.tables[j['joined_table']],
+                                                joined_table_def.included_columns if joined_table_def else '*')
+        join_names = set([j['left_join'].split('.')[-1], j['right_join'].split('.')[-1]])
+        columns += [(j['joined_table'], c) for c in included_columns if join_names != set([c])]
+
+    # An alias must not match any selected column name or earlier alias, so a numbered suffix is added when it would
+    column_names = set([c for t, c in columns])
+    select_list = []
+    names = set()
+    for joined_table_name, column_name in columns:
+        if column_name == '*':
+            select_list.append('%s.*' % joined_table_name)
+        elif column_name in names:
+            alias = '%s_%s' % (joined_table_name, column_name)
+            suffix = 2
+            while alias in names or alias in column_names:
+                alias = '%s_%s_%d' % (joined_table_name, column_name, suffix)
+                suffix += 1
+            names.add(alias)
+            select_list.append('%s.%s AS %s' % (joined_table_name, column_name, alias))
         else:
-            with open(config_file_name) as data_file:
-                db_config = json.load(data_file, object_hook=decode_dict)
-        self.schema = DBSchema(db_config)
+            names.add(column_name)
+            select_list.append('%s.%s' % (joined_table_name, column_name))
+    return ", ".join(select_list)
 
-    def make_sorted_list_from_dict(self, data, table_name, prefix=''):
-        ret_list = []
-        for c in self.schema.tables[table_name].columns:
-            if c not in self.schema.tables[table_name].index_columns:
-                col_label = prefix + c
-                if col_label in data:
-                    if type(data[col_label]) is str:
-                        ret_list.append(data[col_label])
-                    elif type(data[col_label]) is list:
-                        if type(data[col_label][0]) is str:
-                            ret_list.append(data[col_label][0])
-                        else:
-                            return False
+
+CONDITION_OPERATORS = ['=', '!=', '<>', '<', '<=', '>', '>=', 'LIKE', 'IN', 'NOT IN', 'BETWEEN', 'IS NULL',
+                       'IS NOT NULL']
+
+
+def make_where_clause(conditions, placeholder='?', table=None, array_in=False):
+    # Conditions are a list of dicts of column name to value. A value can be a plain value, a list (its first item is
+    # used), None for IS NULL, or a dict of operator to operand, e.g. {'year': {'>=': 1990, '<': 2000}} or
+    # {'director_id': {'IN': [1, 2, 3]}}. Values are always returned as bound parameters.
+    ret_string = ""
+    values = []
+    for c in conditions:
+        for column_name in sorted(c):
+            value = c[column_name]
+            if type(value) is dict:
+                operators = value
+            elif type(value) is list:
+                operators = {'=': value[0]}
+            elif value is None:
+                operators = {'IS NULL': True}
+            else:
+                operators = {'=': value}
+            if table and column_name in table.columns:
+                column_name = '%s.%s' % (table.name, column_name)
+            for operator in sorted(operators):
+                operand = operators[operator]
+                operator = operator.upper()
+                if operator not in CONDITION_OPERATORS:
+                    print 'ERROR: unknown condition operator %s' % operator
+                    return False
+                if ret_string:
+                    ret_string += 'AND '
+                else:
+                    ret_string += 'WHERE '
+                if operator in ('IS NULL', 'IS NOT NULL'):
+                    ret_string += "%s %s " % (column_name, operator)
+                elif operator == 'BETWEEN':
+                    ret_string += "%s BETWEEN %s AND %s " % (column_name, placeholder, placeholder)
+                    values.extend(operand[:2])
+                elif operator in ('IN', 'NOT IN') and array_in:
+                    if operator == 'IN':
+                        ret_string += "%s = ANY(%s) " % (column_name, placeholder)
+                    else:
+                        ret_string += "%s <> ALL(%s) " % (column_name, placeholder)
+                    values.append(list(operand))
+                elif operator in ('IN', 'NOT IN'):
+                    operand = list(operand)
+                    if not operand:
+                        ret_string += "1 = %s " % (0 if operator == 'IN' else 1)
                     else:
-                        return False
+                        ret_string += "%s %s (%s) " % \
+                                      (column_name, operator, make_list_string_from_char(placeholder, len(operand)))
+                        values.extend(operand)
                 else:
+                    ret_string += "%s %s %s " % (column_name, operator, placeholder)
+                    values.append(operand)
+    return ret_string, values
+
+
+def make_keyset_order(order_by, table):
+    # Parses order_by items such as 'year' or 'year DESC' into (column name, descending) pairs and appends the
+    # primary key so that the order is total, which keyset pagination needs. Ordered columns should be NOT NULL.
+    if isinstance(order_by, basestring):
+        order_by = [order_by]
+    order_columns = []
+    for o in order_by or []:
+        parts = o.split()
+        column_name = parts[0]
+        if column_name.startswith(table.name + '.'):
+            column_name = column_name[len(table.name) + 1:]
+        direction = parts[1].upper() if len(parts) > 1 else 'ASC'
+        if column_name not in table.columns or direction not in ('ASC', 'DESC') or len(parts) > 2:
+            print 'ERROR: cannot order %s by %s' % (table.name, o)
+            return False
+        order_columns.append((column_name, direction == 'DESC'))
+    for column_name in table.index_columns:
+        if column_name not in [c[0] for c in order_columns]:
+            order_columns.append((column_name, False))
+    if not order_columns:
+        print 'ERROR: %s has no primary key to paginate on' % table.name
+        return False
+    return order_columns
+
+
+def make_keyset_clause(order_columns, key_values, placeholder='?', table_name=None):
+    # Condition selecting the rows that sort after key_values. A single row value comparison when all columns sort
+    # the same way, which both backends can run as an index range scan, otherwise the expanded OR chain.
+    column_names = [c[0] if not table_name else '%s.%s' % (table_name, c[0]) for c in order_columns]
+    directions = set([c[1] for c in order_columns])
+    if len(directions) == 1:
+        operator = '<' if directions.pop() else '>'
+        if len(column_names) == 1:
+            return "%s %s %s " % (column_names[0], operator, placeholder), list(key_values)
+        return "(%s) %s (%s) " % (", ".join(column_names), operator,
+                                  make_list_string_from_char(placeholder, len(column_names))), list(key_values)
+    terms = []
+    values = []
+    for idx in range(len(order_columns)):
+        term = ["%s = %s" % (column_names[i], placeholder) for i in range(idx)]
+        term.append("%s %s %s" % (column_names[idx], '<' if order_columns[idx][1] else '>', placeholder))
+        terms.append("(%s)" % " AND ".join(term))
+        values.extend(key_values[:idx + 1])
+    return "(%s) " % " OR ".join(terms), values
+
+
+def make_keyset_order_clause(order_columns, table_name):
+    return "ORDER BY %s " % ", ".join(["%s.%s%s" % (table_name, c[0], ' DESC' if c[1] else '') for c in order_columns])
+
+
+def encode_page_token(key_values):
+    return base64.urlsafe_b64encode(json.dumps(list(key_values), default=str))
+
+
+def decode_page_token(token, num_values):
+    try:
+        key_values = json.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        key_values = None
+    if type(key_values) is not list or len(key_values) != num_values:
+        print 'ERROR: invalid page token %s' % token
+        return False
+    return key_values
+
+
+ROW_FORMATS = ['dict', 'tuple', 'row', 'record']
+_identifier_re = re.compile(r'[A-Za-z][A-Za-z0-9_]*$')
+
+
+def make_record_class(class_name, column_names):
+    # Builds a tuple subclass whose constructor takes a whole result row. When a column name appears more than once
+    # (join keys), the last value wins, as it does for dict rows. Fields are read by name or position, e.g.
+    # record['count(*)'] or record[0], and also as attributes when the name is a plain identifier that is not a
+    # keyword and does not clash with a tuple or record method, e.g. record.year.
+    field_indexes = collections.OrderedDict()
+    for idx, column_name in enumerate(column_names):
+        field_indexes[column_name] = idx
+    fields = tuple(field_indexes)
+    positions = dict([(f, position) for position, f in enumerate(fields)])
+    get_values = operator.itemgetter(*field_indexes.values()) if fields else None
+
+    def __new__(cls, row):
+        if len(fields) > 1:
+            return tuple.__new__(cls, get_values(row))
+        return tuple.__new__(cls, (get_values(row),) if fields else ())
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, long, slice)):
+            return tuple.__getitem__(self, key)
+        if key not in positions:
+            raise KeyError(key)
+        return tuple.__getitem__(self, positions[key])
+
+    def __eq__(self, other):
+        return type(other) is type(self) and tuple.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "%s(%s)" % (class_name, ", ".join(["%s=%r" % (f, v) for f, v in zip(fields, self)]))
+
+    def keys(self):
+        return list(fields)
+
+    namespace = {'__slots__': (), '__new__': __new__, '__getitem__': __getitem__, '__eq__': __eq__, '__ne__': __ne__,
+                 '__repr__': __repr__, 'keys': keys}
+    for position, field in enumerate(fields):
+        if _identifier_re.match(field) and not keyword.iskeyword(field) and field not in namespace and \
+                not hasattr(tuple, field):
+            namespace[field] = property(operator.itemgetter(position))
+    return type(class_name, (tuple,), namespace)
+
+
+NUMPY_TYPES = {'INTEGER': 'i8', 'INT': 'i8', 'BIGINT': 'i8', 'SMALLINT': 'i8', 'SERIAL': 'i8', 'REAL': 'f8',
+               'FLOAT': 'f8', 'DOUBLE': 'f8', 'NUMERIC': 'f8', 'BOOLEAN': '?'}
+
+
+def get_numpy_dtype(column):
+    for column_type in column.type:
+        if column_type.upper() in NUMPY_TYPES:
+            return NUMPY_TYPES[column_type.upper()]
+    return 'O'
+
+
+def _make_column_array(values, dtype):
+    if dtype == '?' and None in values:
+        # numpy reads None as False, so NULLs in a boolean column fall back to objects
+        return numpy.array(values, dtype='O')
+    try:
+        return numpy.array(values, dtype=dtype)
+    except (TypeError, ValueError):
+        # NULLs in a numeric column; integers become floats with NaN, anything else falls back to objects
+        if dtype == 'i8':
+            try:
+                return numpy.array(values, dtype='f8')
+            except (TypeError, ValueError):
+                pass
+        return numpy.array(values, dtype='O')
+
+
+def make_column_arrays(chunks, column_names, dtypes, structured=False):
+    # Builds one array per column from chunks of tuple rows, without an intermediate object per row
+    column_chunks = [[] for _ in column_names]
+    for chunk in chunks:
+        for idx, values in enumerate(zip(*chunk)):
+            column_chunks[idx].append(_make_column_array(values, dtypes[idx]))
+    arrays = []
+    for idx, chunk_arrays in enumerate(column_chunks):
+        if chunk_arrays:
+            arrays.append(numpy.concatenate(chunk_arrays))
+        else:
+            arrays.append(numpy.array([], dtype=dtypes[idx]))
+
+    if not structured:
+        return dict(zip(column_names, arrays))
+
+    num_rows = len(arrays[0]) if arrays else 0
+    ret_array = numpy.empty(num_rows, dtype=[(name, arrays[idx].dtype) for idx, name in enumerate(column_names)])
+    for idx, column_name in enumerate(column_names):
+        ret_array[column_name] = arrays[idx]
+    return ret_array
+
+
+def chunk_iterable(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def changes_table(method):
+    # Marks a DB method that writes to the table named by its first argument, so cached rows of it are invalidated
+    @functools.wraps(method)
+    def wrapper(self, table_name, *args, **kwargs):
+        try:
+            return method(self, table_name, *args, **kwargs)
+        finally:
+            self.table_changed(table_name)
+    return wrapper
+
+
+class LookupCache:
+    # LRU cache of rows keyed by table name and primary key. Each table holds at most max_size rows, entries older
+    # than ttl seconds are treated as missing, and invalidating a table drops all of its rows at once.
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.tables = {}
+        self.table_versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, table_name, key):
+        with self.lock:
+            table_rows = self.tables.get(table_name)
+            entry = table_rows.pop(key, None) if table_rows is not None else None
+            if entry is None or (self.ttl is not None and time.time() - entry[1] > self.ttl):
+                self.misses += 1
+                return None
+            table_rows[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def get_version(self, table_name):
+        # Taken before reading the rows to put, so rows read before an invalidation are not stored after it
+        with self.lock:
+            return self.table_versions.get(table_name, 0)
+
+    def put(self, table_name, key, row, version=None):
+        with self.lock:
+            if version is not None and self.table_versions.get(table_name, 0) != version:
+                return
+            table_rows = self.tables.setdefault(table_name, collections.OrderedDict())
+            table_rows.pop(key, None)
+            table_rows[key] = (row, time.time())
+            while len(table_rows) > self.max_size:
+                table_rows.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_table(self, table_name):
+        with self.lock:
+            self.table_versions[table_name] = self.table_versions.get(table_name, 0) + 1
+            self.tables.pop(table_name, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': sum([len(t) for t in self.tables.values()])}
+
+
+class FrozenRow(dict):
+    # Read-only dict row, so that rows held by the query cache can be shared between callers and threads
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('cached rows are read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+def _make_hashable(value):
+    if isinstance(value, (list, tuple)):
+        return tuple([_make_hashable(v) for v in value])
+    return value
+
+
+class QueryCache:
+    # Read-through cache of select results keyed by the normalized statement and its parameters. Every entry keeps
+    # the version of each table it reads; writes bump the table version, which makes the dependent entries stale
+    # without having to find them. Holds at most max_rows rows in total, evicting the least recently used entries.
+    def __init__(self, max_rows=100000, immutable=False):
+        self.max_rows = max_rows
+        self.immutable = immutable
+        self.entries = collections.OrderedDict()
+        self.table_versions = {}
+        self.num_rows = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_key(self, row_format, command, values):
+        return row_format, " ".join(command.split()), _make_hashable(values or ())
+
+    def _share_rows(self, rows):
+        if self.immutable:
+            return rows
+        return [dict(r) if type(r) is dict else r for r in rows]
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            rows, versions = entry
+            for table_name in versions:
+                if self.table_versions.get(table_name, 0) != versions[table_name]:
+                    self.num_rows -= len(rows)
+                    self.misses += 1
+                    return None
+            self.entries[key] = entry
+            self.hits += 1
+        return self._share_rows(rows)
+
+    def get_versions(self, table_names):
+        # Taken before running the query, so a write that lands while it runs leaves the entry stale
+        with self.lock:
+            return dict([(t, self.table_versions.get(t, 0)) for t in table_names])
+
+    def put(self, key, versions, rows):
+        if self.immutable:
+            rows = tuple([FrozenRow(r) if type(r) is dict else r for r in rows])
+        else:
+            rows = self._share_rows(rows)
+        if len(rows) > self.max_rows:
+            return self._share_rows(rows)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry:
+                self.num_rows -= len(old_entry[0])
+            self.entries[key] = (rows, versions)
+            self.num_rows += len(rows)
+            while self.num_rows > self.max_rows:
+                evicted_rows = self.entries.popitem(last=False)[1][0]
+                self.num_rows -= len(evicted_rows)
+                self.evictions += 1
+        return self._share_rows(rows)
+
+    def table_changed(self, table_name):
+        with self.lock:
+            self.table_versions[table_name] = self.table_versions.get(table_name, 0) + 1
+
+    def get_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.entries), 'rows': self.num_rows}
+
+
+_placeholder_list_re = re.compile(r"\(\s*(\?|%s)(\s*,\s*(\?|%s))+\s*\)")
+
+
+def get_statement_shape(command):
+    # Statements are built with placeholders, so only the length of IN and VALUES lists tells calls apart
+    return _placeholder_list_re.sub('(...)', " ".join(command.split()))
+
+
+class Instrumentation:
+    # Statement timing for the DB classes. Before hooks are called with (command, values) and after hooks with
+    # (command, values, seconds, rows, error). Statements are aggregated by shape, with percentiles taken from a
+    # reservoir sample of at most reservoir_size latencies per shape. Statements slower than slow_query_ms are
+    # kept in slow_queries together with the plan returned by explain(command, values).
+    def __init__(self, explain=None, slow_query_ms=None, reservoir_size=1000, slow_query_log_size=100):
+        self.explain = explain
+        self.slow_query_ms = slow_query_ms
+        self.reservoir_size = reservoir_size
+        self.before_hooks = []
+        self.after_hooks = []
+        self.shapes = {}
+        self.shape_names = {}
+        self.slow_queries = collections.deque(maxlen=slow_query_log_size)
+        self.lock = threading.Lock()
+        self.random = random.Random()
+
+    def add_hooks(self, before=None, after=None):
+        if before:
+            self.before_hooks.append(before)
+        if after:
+            self.after_hooks.append(after)
+
+    def call_hooks(self, hooks, *args):
+        # A failing hook is reported and skipped, so it cannot fail the statement it observes
+        for hook in hooks:
+            try:
+                hook(*args)
+            except Exception as e:
+                print 'ERROR: instrumentation hook %s failed: %s' % (getattr(hook, '__name__', hook), e)
+
+    def before(self, command, values):
+        self.call_hooks(self.before_hooks, command, values)
+        return time.time()
+
+    def after(self, command, values, start, rows=None, error=None):
+        seconds = time.time() - start
+        shape = self.shape_names.get(command)
+        if shape is None:
+            if len(self.shape_names) > 10000:
+                self.shape_names.clear()
+            shape = self.shape_names[command] = get_statement_shape(command)
+        with self.lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = {'count': 0, 'total': 0.0, 'rows': 0, 'errors': 0, 'samples': []}
+            stats['count'] += 1
+            stats['total'] += seconds
+            if rows:
+                stats['rows'] += rows
+            if error is not None:
+                stats['errors'] += 1
+            if len(stats['samples']) < self.reservoir_size:
+                stats['samples'].append(seconds)
+            else:
+                idx = self.random.randint(0, stats['count'] - 1)
+                if idx < self.reservoir_size:
+                    stats['samples'][idx] = seconds
+
+        if self.slow_query_ms is not None and error is None and seconds * 1000 >= self.slow_query_ms:
+            self.slow_queries.append({'sql': command, 'values': values, 'seconds': seconds, 'rows': rows,
+                                      'time': start, 'plan': self.explain(command, values) if self.explain else None})
+        self.call_hooks(self.after_hooks, command, values, seconds, rows, error)
+
+    def get_stats(self):
+        ret_dict = {}
+        with self.lock:
+            for shape in self.shapes:
+                stats = self.shapes[shape]
+                samples = sorted(stats['samples'])
+                ret_dict[shape] = {'count': stats['count'], 'total_ms': stats['total'] * 1000, 'rows': stats['rows'],
+                                   'errors': stats['errors'], 'p50_ms': samples[len(samples) // 2] * 1000,
+                                   'p99_ms': samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000}
+        return ret_dict
+
+    def reset(self):
+        with self.lock:
+            self.shapes = {}
+            self.slow_queries.clear()
+
+
+SCHEMA_CACHE_VERSION = 1
+_schemas = {}
+_schemas_lock = threading.RLock()
+
+
+def load_config(config_file_name):
+    if config_file_name[-5:] == '.toml':
+        with open(config_file_name) as data_file:
+            return pytoml.load(data_file)
+    with open(config_file_name) as data_file:
+        return json.load(data_file, object_hook=decode_dict)
+
+
+def _read_schema_cache(cache_file_name, config_key):
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            cache = marshal.load(cache_file)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if type(cache) is not dict or cache.get('version') != SCHEMA_CACHE_VERSION or cache.get('config') != config_key:
+        return None
+    return cache
+
+
+def _write_schema_cache(schema):
+    # Written to a temporary file and renamed, so concurrent workers never read a partial cache. A config directory
+    # that is not writable just means no cache.
+    cache = {'version': SCHEMA_CACHE_VERSION, 'config': schema.config_key, 'db_config': schema.db_config,
+             'order': schema.get_schema_order(), 'statements': schema.compiled_statements}
+    tmp_file_name = '%s.%s.tmp' % (schema.cache_file_name, os.getpid())
+    try:
+        with open(tmp_file_name, 'wb') as cache_file:
+            marshal.dump(cache, cache_file)
+        os.rename(tmp_file_name, schema.cache_file_name)
+    except (IOError, OSError, ValueError):
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+
+
+def load_schema(config_file_name, cache_file=True):
+    # Process-wide schema registry keyed by the config path, mtime and size, so DB objects built from the same
+    # unchanged config share one DBSchema. Its table definitions are not changed after loading; compiled_statements
+    # gains an entry per backend, added by get_compiled_statements under _schemas_lock. With cache_file, the parsed
+    # config and the compiled statements are also kept in a marshal file next to the config, which lets a cold start
+    # skip parsing.
+    path = os.path.abspath(config_file_name)
+    stat = os.stat(path)
+    config_key = (path, stat.st_mtime, stat.st_size)
+    with _schemas_lock:
+        schema = _schemas.get(config_key)
+        if schema is not None:
+            return schema
+        cache_file_name = path + '.cache'
+        cache = _read_schema_cache(cache_file_name, config_key) if cache_file else None
+        db_config = cache['db_config'] if cache else load_config(path)
+        schema = DBSchema(db_config, cache['order'] if cache else None)
+        schema.db_config = db_config
+        schema.config_key = config_key
+        if cache_file:
+            schema.cache_file_name = cache_file_name
+        if cache:
+            schema.compiled_statements = cache['statements']
+        _schemas[config_key] = schema
+        return schema
+
+
+def get_compiled_statements(schema, backend, compile_statements):
+    # Statements of a backend are compiled once per schema, or taken from the cache file. The backend name should
+    # change whenever its statement builders do.
+    with _schemas_lock:
+        statements = schema.compiled_statements.get(backend)
+        if statements is None or [s for s in statements.values() if len(s) != len(TableStatements._fields)]:
+            statements = dict([(t, tuple(s)) for t, s in compile_statements().items()])
+            schema.compiled_statements[backend] = statements
+            if schema.cache_file_name:
+                _write_schema_cache(schema)
+    return dict([(t, TableStatements(*s)) for t, s in statements.items()])
+
+
+SCHEMA_META_TABLE = 'dbmangler_meta'
+
+
+def diff_schema(schema, db_tables, get_column_type):
+    # Compares introspected tables, {table name: {'columns': [{'name', 'type', ...}], 'indexes': [{'name', ...}]}},
+    # with the schema. Returns the missing tables, the missing columns and indexes as (table name, name) pairs and
+    # the differences that cannot be migrated automatically. get_column_type(column) gives the type the DB reports
+    # for a schema column, or None to skip comparing it. Extra tables, columns and indexes in the DB are left alone.
+    missing_tables = []
+    missing_columns = []
+    missing_indexes = []
+    problems = []
+    for table_name in schema.tables:
+        table = schema.tables[table_name]
+        if table_name not in db_tables:
+            missing_tables.append(table_name)
+            continue
+        db_columns = dict([(c['name'], c) for c in db_tables[table_name]['columns']])
+        for column_name in table.columns:
+            column = table.columns[column_name]
+            if column_name not in db_columns:
+                if 'PRIMARY KEY' in column.type or 'UNIQUE' in column.type:
+                    problems.append('Column %s.%s is missing and cannot be added to an existing table' %
+                                    (table_name, column_name))
+                else:
+                    missing_columns.append((table_name, column_name))
+                continue
+            column_type = get_column_type(column)
+            if column_type and db_columns[column_name]['type'].lower() != column_type.lower():
+                problems.append('Column %s.%s is %s in the DB but %s in the schema' %
+                                (table_name, column_name, db_columns[column_name]['type'], column_type))
+        db_indexes = [i['name'] for i in db_tables[table_name]['indexes']]
+        for index_name in sorted(table.indexes):
+            if index_name not in db_indexes:
+                missing_indexes.append((table_name, index_name))
+    return missing_tables, missing_columns, missing_indexes, problems
+
+
+def _to_integer(value):
+    if isinstance(value, basestring) or type(value) is bool:
+        return int(value)
+    return value
+
+
+def _to_real(value):
+    if isinstance(value, basestring):
+        return float(value)
+    return value
+
+
+def _to_text(value):
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def _to_boolean(value):
+    if isinstance(value, basestring):
+        word = value.strip().lower()
+        if word in ('1', 't', 'true', 'y', 'yes', 'on'):
+            return True
+        if word in ('0', 'f', 'false', 'n', 'no', 'off'):
+            return False
+        raise ValueError('invalid boolean value: %r' % value)
+    return bool(value)
+
+
+COLUMN_COERCIONS = {'INTEGER': _to_integer, 'INT': _to_integer, 'BIGINT': _to_integer, 'SMALLINT': _to_integer,
+                    'SERIAL': _to_integer, 'REAL': _to_real, 'FLOAT': _to_real, 'DOUBLE': _to_real, 'TEXT': _to_text,
+                    'VARCHAR': _to_text, 'BOOLEAN': _to_boolean}
+
+
+class RowEncoder:
+    # Turns a row, given as a dict of column name to value or as a sequence in column order, into the parameter list
+    # of the table's insert statement in one pass. Values wrapped in a list are unwrapped, strings are coerced to the
+    # declared numeric and boolean types and numbers to text, None stays NULL. Built once per table by DBSchema;
+    # other column lists, e.g. including the primary key, get their own encoder.
+    def __init__(self, table, column_names=None):
+        self.table_name = table.name
+        self.column_names = tuple(column_names or table.get_column_names(exclude_index=True))
+        self.coercions = tuple([COLUMN_COERCIONS.get(table.columns[c].type[0].upper()) for c in self.column_names])
+        self.columns = tuple(zip(self.column_names, self.coercions))
+
+    def encode(self, data, prefix=''):
+        # None stands for a row that could not be read and was reported already
+        if data is None:
+            return False
+        encoded = []
+        try:
+            if type(data) is dict:
+                for column_name, coerce in self.columns:
+                    value = data[prefix + column_name]
+                    if type(value) is list:
+                        value = value[0]
+                    if value is not None and coerce is not None:
+                        value = coerce(value)
+                    encoded.append(value)
+            else:
+                if len(data) != len(self.columns):
+                    print 'ERROR: number of columns and items in data do not match'
                     return False
-        return ret_list
+                for value, coerce in zip(data, self.coercions):
+                    if type(value) is list:
+                        value = value[0]
+                    if value is not None and coerce is not None:
+                        value = coerce(value)
+                    encoded.append(value)
+        except KeyError as e:
+            print 'ERROR: column %s missing in data for %s' % (e, self.table_name)
+            return False
+        except (ValueError, TypeError, IndexError) as e:
+            print 'ERROR: could not encode data for %s: %s' % (self.table_name, e)
+            return False
+        return encoded
+
+    def encode_many(self, rows):
+        # Returns the encoded rows, e.g. for executemany, and the number of rows that could not be encoded
+        encoded_rows = []
+        num_rejected = 0
+        for row in rows:
+            encoded = self.encode(row)
+            if encoded is False:
+                num_rejected += 1
+            else:
+                encoded_rows.append(encoded)
+        return encoded_rows, num_rejected
+
+
+EXPORT_FORMATS = ['csv', 'jsonl']
+# CSV cannot tell NULL from an empty string, so NULL is written as \N, as Postgres COPY does in text format
+CSV_NULL = '\\N'
+
+
+class TransferProgress:
+    # Counts the rows of an export or import and passes the running stats to callback every report_every rows
+    def __init__(self, table_name, callback=None, report_every=10000):
+        self.table_name = table_name
+        self.callback = callback
+        self.report_every = report_every
+        self.rows = 0
+        self.rows_rejected = 0
+        self.next_report = report_every
+        self.start = time.time()
+
+    def add(self, num_rows, num_rejected=0):
+        self.rows += num_rows
+        self.rows_rejected += num_rejected
+        if self.callback and self.rows >= self.next_report:
+            self.next_report = self.rows + self.report_every
+            self.callback(self.get_stats())
+
+    def get_stats(self):
+        seconds = time.time() - self.start
+        return {'table': self.table_name, 'rows': self.rows, 'rows_rejected': self.rows_rejected,
+                'seconds': seconds, 'rows_per_sec': self.rows / seconds if seconds else None}
+
+    def finish(self):
+        stats = self.get_stats()
+        if self.callback:
+            self.callback(stats)
+        return stats
+
+
+class CountingFile:
+    # File wrapper that counts the rows COPY ... TO STDOUT writes; psycopg2 writes each row with its own call, so
+    # values spanning lines are counted once
+    def __init__(self, fileobj, transfer):
+        self.fileobj = fileobj
+        self.transfer = transfer
+
+    def write(self, data):
+        self.transfer.add(1)
+        return self.fileobj.write(data)
+
+
+def _make_csv_value(value):
+    if value is None:
+        return CSV_NULL
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def export_rows(fileobj, file_format, column_names, chunks, transfer):
+    # Writes chunks of tuple rows as CSV with a header line or as one JSON object per line
+    if file_format == 'csv':
+        writer = csv.writer(fileobj)
+        writer.writerow(column_names)
+        for rows in chunks:
+            writer.writerows([[_make_csv_value(v) for v in row] for row in rows])
+            transfer.add(len(rows))
+    else:
+        for rows in chunks:
+            fileobj.write("".join([json.dumps(dict(zip(column_names, row)), default=str) + "\n" for row in rows]))
+            transfer.add(len(rows))
+
+
+def parse_json_line(line):
+    # One JSON Lines object as a dict, or None, after reporting it, if the line is not a JSON object
+    try:
+        row = json.loads(line, object_hook=decode_dict)
+    except ValueError as e:
+        print 'ERROR: could not parse JSON line: %s' % e
+        return None
+    if type(row) is not dict:
+        print 'ERROR: JSON line is not an object: %s' % line.strip()[:100]
+        return None
+    return row
+
+
+def read_import_rows(fileobj, file_format):
+    # Returns the column names and an iterator of rows as lists. CSV columns come from the header line, JSON Lines
+    # columns from the keys of the first object; a JSON line that cannot be parsed is yielded as None, which the
+    # row encoders count as rejected. A CSV file that cannot be parsed raises csv.Error while iterating.
+    if file_format == 'csv':
+        reader = csv.reader(fileobj)
+        column_names = next(reader, [])
+        return column_names, ([None if v == CSV_NULL else v for v in row] for row in reader)
+    lines = (line for line in fileobj if line.strip())
+    first_line = next(lines, None)
+    first_row = parse_json_line(first_line) if first_line is not None else None
+    if first_row is None:
+        return [], iter([])
+    column_names = sorted(first_row)
+    rows = itertools.chain([first_row], (parse_json_line(line) for line in lines))
+    return column_names, (None if row is None else [row.get(c) for c in column_names] for row in rows)
+
+
+def check_import_columns(table, column_names):
+    unknown_columns = [c for c in column_names if c not in table.columns]
+    if not column_names or unknown_columns:
+        print 'ERROR: columns %s do not match table %s' % (", ".join(unknown_columns or ['(none)']), table.name)
+        return False
+    return True
+
+
+class DB:
+    # Backend-independent part of the SQLite and Postgres DB classes, which inherit from it. Backends set placeholder
+    # to their parameter marker and array_in when a list of values binds to a single = ANY(...) parameter.
+    placeholder = '?'
+    array_in = False
+
+    def __init__(self, config_file_name='example_db_config.json', row_format='dict'):
+        self.schema = load_schema(config_file_name)
+        if row_format not in ROW_FORMATS:
+            raise ValueError('Unknown row format: %s' % row_format)
+        self.row_format = row_format
+        self.record_classes = {}
+        self.update_by_key_statements = {}
+        self.lookup_cache = None
+        self.query_cache = None
+        self.instrumentation = None
+
+    def make_sorted_list_from_dict(self, data, table_name, prefix=''):
+        return self.schema.encoders[table_name].encode(data, prefix)
 
     def _check_data(self, table_name, data):
 
+        if table_name not in self.schema.encoders:
+            return False
+
+        return self.schema.encoders[table_name].encode(data)
+
+    def _get_key_list(self, table_name, key):
+        if type(key) is dict:
+            return [key[c] for c in self.schema.tables[table_name].index_columns]
+        if type(key) in (list, tuple):
+            return list(key)
+        return [key]
+
+    def _split_key_row(self, table_name, row):
+        # Splits a dict holding the primary key and the changed columns into (changed column names, values)
+        table = self.schema.tables[table_name]
+        column_names = tuple(sorted([c for c in row if c not in table.index_columns]))
+        for c in column_names + tuple(table.index_columns):
+            if c not in table.columns or c not in row:
+                print 'ERROR: column %s missing or not in table %s' % (c, table_name)
+                return False
+        values = [row[c] for c in column_names] + [row[c] for c in table.index_columns]
+        return column_names, values
+
+    def _get_update_by_key_command(self, table_name, column_names):
+        statement_key = (table_name, column_names)
+        if statement_key not in self.update_by_key_statements:
+            self.update_by_key_statements[statement_key] = self.make_update_by_key_command(table_name, column_names)
+        return self.update_by_key_statements[statement_key]
+
+    def get_record_class(self, description):
+        column_names = tuple([d[0] for d in description])
+        if column_names not in self.record_classes:
+            self.record_classes[column_names] = make_record_class('Record', column_names)
+        return self.record_classes[column_names]
+
+    def enable_lookup_cache(self, max_size=10000, ttl=None):
+        self.lookup_cache = LookupCache(max_size, ttl)
+
+    def enable_query_cache(self, max_rows=100000, immutable=False):
+        self.query_cache = QueryCache(max_rows, immutable)
+
+    def enable_instrumentation(self, slow_query_ms=None, explain=True, reservoir_size=1000, slow_query_log_size=100):
+        self.instrumentation = Instrumentation(self.explain_command if explain else None, slow_query_ms,
+                                               reservoir_size, slow_query_log_size)
+        return self.instrumentation
+
+    def in_transaction(self):
+        # Whether this thread's connection is inside a transaction() block, without opening a connection to find out
+        con = self._get_current_connection()
+        return bool(con is not None and con.transaction_depth)
+
+    def table_changed(self, table_name):
+        # A write inside a transaction is only visible to other connections once the outermost block commits. Until
+        # then they can still read and cache the old rows, so the table is invalidated again by _tables_committed.
+        con = self._get_current_connection()
+        if con is not None and con.transaction_depth:
+            con.changed_tables.add(table_name)
+        if self.lookup_cache:
+            # Cached rows carry the included columns of the tables they join, so those rows are dropped as well
+            for dependent_table_name in self.get_dependent_tables(table_name):
+                self.lookup_cache.invalidate_table(dependent_table_name)
+        if self.query_cache:
+            self.query_cache.table_changed(table_name)
+
+    def _tables_committed(self, con):
+        # Called after the outermost transaction block on con commits
+        changed_tables, con.changed_tables = con.changed_tables, set()
+        for table_name in changed_tables:
+            self.table_changed(table_name)
+
+    def get_select_dependencies(self, table_name, additional_joins=None):
+        tables = [table_name]
+        for column_info in self.schema.tables[table_name].columns.values():
+            if 'FOREIGN KEY' in column_info.type:
+                tables.append(column_info.foreign_key['table'])
+        for j in additional_joins or []:
+            tables.append(j['joined_table'])
+        return tables
+
+    def get_dependent_tables(self, table_name):
+        # The table itself and every table whose select reads it through a foreign key join
+        return [table_name] + [t for t in self.schema.tables
+                               if t != table_name and table_name in self.get_select_dependencies(t)]
+
+    def get_rows_by_key(self, table_name, keys, batch_size=500):
+        # Returns a dict of primary key to row (as a dict) for a table with a single primary key column. With the
+        # lookup cache enabled, only the keys missing from the cache are fetched.
+        if table_name not in self.schema.tables or len(self.schema.tables[table_name].index_columns) != 1:
+            return False
+
+        index_column = self.schema.tables[table_name].index_columns[0]
+        # Rows read inside a transaction may be uncommitted and vanish on rollback, so the cache is bypassed there
+        lookup_cache = self.lookup_cache if not self.in_transaction() else None
+        rows = {}
+        missing_keys = []
+        for key in set(keys):
+            row = lookup_cache.get(table_name, key) if lookup_cache else None
+            if row is None:
+                missing_keys.append(key)
+            else:
+                rows[key] = row
+
+        version = lookup_cache.get_version(table_name) if lookup_cache else None
+        for batch in chunk_iterable(missing_keys, batch_size):
+            select_command = self.make_subset_select_command(table_name, [{index_column: {'IN': batch}}])
+            if not select_command:
+                return False
+            res = self.run_select_command(select_command[0], select_command[1], row_format='dict')
+            if res is False:
+                return False
+            for row in res:
+                rows[row[index_column]] = row
+                if lookup_cache:
+                    lookup_cache.put(table_name, row[index_column], row, version)
+
+        return rows
+
+    def get_joined_table_rows(self, table_name, rows=None):
+        # Without rows, returns every row of each table referenced by a foreign key. With rows, returns only the
+        # referenced rows that those rows point to.
+        joined_tables = {}
+        for column_name in self.schema.tables[table_name].columns:
+            fk = getattr(self.schema.tables[table_name].columns[column_name], 'foreign_key', None)
+            if not fk:
+                continue
+            if rows is None:
+                if fk['table'] not in joined_tables:
+                    joined_tables[fk['table']] = self.get_all_table_rows(fk['table'])
+                continue
+            keys = [r[column_name] for r in rows if r[column_name] is not None]
+            referenced_rows = self.get_rows_by_key(fk['table'], keys)
+            if referenced_rows is False:
+                return False
+            joined_tables.setdefault(fk['table'], {}).update(referenced_rows)
+        if rows is not None:
+            for joined_table_name in joined_tables:
+                joined_tables[joined_table_name] = joined_tables[joined_table_name].values()
+        return joined_tables
+
+    def make_subset_select_command(self, table_name, conditions, additional_joins=None, order_and_limit=None,
+                                   columns=None):
+
+        if table_name not in self.schema.tables:
+            return False
+
+        if not additional_joins and not columns:
+            select_command = self.statements[table_name].select
+        else:
+            select_command = self.make_complex_select_command(table_name, additional_joins or [], columns)
+        if not select_command:
+            return False
+        where_clause = make_where_clause(conditions, self.placeholder, self.schema.tables[table_name],
+                                         array_in=self.array_in)
+        if not where_clause:
+            return False
+        select_command += where_clause[0]
+        values = where_clause[1]
+
+        if order_and_limit:
+            if 'order' in order_and_limit.keys():
+                first_item = True
+                for o in order_and_limit['order']:
+                    if first_item:
+                        first_item = False
+                        select_command += 'ORDER BY '
+                    else:
+                        select_command += ', '
+                    select_command += '%s ' % o
+            if 'limit' in order_and_limit.keys():
+                select_command += 'LIMIT %s ' % self.placeholder
+                values.append(int(order_and_limit['limit']))
+
+        return select_command, values
+
+    def iter_subset_table_rows(self, table_name, conditions, additional_joins=None, order_and_limit=None,
+                               fetch_size=None, columns=None):
+
+        select_command = self.make_subset_select_command(table_name, conditions, additional_joins, order_and_limit,
+                                                         columns)
+        if not select_command:
+            return False
+
+        return self.iter_select_command(select_command[0], select_command[1], fetch_size)
+
+    def get_subset_table_rows(self, table_name, conditions, additional_joins=None, order_and_limit=None,
+                              columns=None):
+
+        select_command = self.make_subset_select_command(table_name, conditions, additional_joins, order_and_limit,
+                                                         columns)
+        if not select_command:
+            return False
+
+        return self.run_cached_select_command(select_command[0], select_command[1],
+                                              self.get_select_dependencies(table_name, additional_joins))
+
+    def paginate(self, table_name, conditions, order_by, page_size, after=None, additional_joins=None):
+        # Keyset pagination: each page continues after the ordering values of the last row of the previous page
+        # rather than skipping an offset, so deep pages cost the same as the first. Returns the rows and the token
+        # for the next page, which is None on the last page.
+
+        if table_name not in self.schema.tables or int(page_size) < 1:
+            return False
+        table = self.schema.tables[table_name]
+        order_columns = make_keyset_order(order_by, table)
+        if not order_columns:
+            return False
+
+        if not additional_joins:
+            select_command = self.statements[table_name].select
+        else:
+            select_command = self.make_complex_select_command(table_name, additional_joins)
+        where_clause = make_where_clause(conditions, self.placeholder, table, array_in=self.array_in)
+        if not where_clause:
+            return False
+        select_command += where_clause[0]
+        values = where_clause[1]
+
+        if after:
+            key_values = decode_page_token(after, len(order_columns))
+            if key_values is False:
+                return False
+            keyset_clause = make_keyset_clause(order_columns, key_values, self.placeholder, table_name)
+            select_command += ('AND ' if where_clause[0] else 'WHERE ') + keyset_clause[0]
+            values += keyset_clause[1]
+        select_command += make_keyset_order_clause(order_columns, table_name)
+        select_command += 'LIMIT %s ' % self.placeholder
+        values.append(int(page_size) + 1)
+
+        rows = self.run_cached_select_command(select_command, values,
+                                              self.get_select_dependencies(table_name, additional_joins))
+        if rows is False:
+            return False
+        if len(rows) <= int(page_size):
+            return rows, None
+
+        # Dict and record rows are read by name, tuple-like rows by the position of the base table column
+        rows = rows[:int(page_size)]
+        last_row = rows[-1]
+        if self.row_format in ('dict', 'record'):
+            key_values = [last_row[c[0]] for c in order_columns]
+        else:
+            column_names = list(table.columns)
+            key_values = [last_row[column_names.index(c[0])] for c in order_columns]
+
+        return rows, encode_page_token(key_values)
+
+    def iter_table_rows(self, table_name, fetch_size=None):
+
+        if table_name not in self.statements:
+            return False
+
+        return self.iter_select_command(self.statements[table_name].select, fetch_size=fetch_size)
+
+    def fetch_columns(self, table_name, columns=None, conditions=None, structured=False, fetch_size=None):
+        # Returns a dict of NumPy arrays keyed by column name, or a structured array, with dtypes taken from the
+        # declared column types
+        if not numpy:
+            print 'ERROR: fetch_columns requires numpy'
+            return False
+
         if table_name not in self.schema.tables:
             return False
 
-        if len(data) < self.schema.tables[table_name].get_num_columns(exclude_index=True):
-            print 'ERROR: number of columns and items in data do not match'
+        table = self.schema.tables[table_name]
+        if not columns:
+            columns = list(table.columns)
+        for column_name in columns:
+            if column_name not in table.columns:
+                print 'ERROR: unknown column %s in table %s' % (column_name, table_name)
+                return False
+
+        select_command = "SELECT %s FROM %s " % (", ".join(columns), table_name)
+        where_clause = make_where_clause(conditions or [], self.placeholder, table, array_in=self.array_in)
+        if not where_clause:
+            return False
+        select_command += where_clause[0]
+
+        chunks = self.iter_select_command(select_command, where_clause[1], fetch_size, row_format='tuple',
+                                          chunked=True)
+        if chunks is False:
+            return False
+
+        dtypes = [get_numpy_dtype(table.columns[c]) for c in columns]
+
+        return make_column_arrays(chunks, columns, dtypes, structured)
+
+    def check_schema(self, create_schema=True):
+        # Skipped while the fingerprint stored in the DB matches the schema. Otherwise the catalog is compared with
+        # the schema and, with create_schema, missing tables, columns and indexes are added in one transaction.
+        if self.get_schema_fingerprint() == self.schema.fingerprint:
+            return True
+
+        db_tables = self.make_schema_object()
+        if db_tables is False:
+            return False
+
+        if not db_tables:
+            if not create_schema:
+                print "No schema found."
+                return False
+            print "No schema found. Creating DB schema."
+
+        changes = self.get_schema_changes(db_tables)
+        if changes is False:
+            return False
+        if changes and not create_schema:
+            for command in changes:
+                print "Schema change needed: %s" % command
             return False
 
-        if type(data) is dict:
-            data = self.make_sorted_list_from_dict(data, table_name)
-            if not data:
-                print 'ERROR: could not make list from data dict'
+        return self.migrate_schema(changes)
+
+    def make_export_select_command(self, table_name):
+        # The table's own columns, primary key included, in primary key order
+        table = self.schema.tables[table_name]
+        select_command = "SELECT %s FROM %s" % (table.get_columns_string(), table_name)
+        if table.index_columns:
+            select_command += " ORDER BY %s" % ", ".join(table.index_columns)
+        return select_command
+
+    def export_tables(self, directory, file_format='csv', table_names=None, progress=None):
+        # Writes each table to <directory>/<table name>.<file_format>, returning the stats of every table
+        stats = {}
+        for table_name in table_names or self.schema.get_table_load_order():
+            with open(os.path.join(directory, '%s.%s' % (table_name, file_format)), 'wb') as fileobj:
+                stats[table_name] = self.export_table(table_name, fileobj, file_format, progress)
+            if stats[table_name] is False:
                 return False
+        return stats
 
-        return data
+    def import_tables(self, directory, file_format='csv', table_names=None, progress=None):
+        # Imports the exported files in foreign key order, so referenced rows exist before the rows pointing at them
+        stats = {}
+        for table_name in self.schema.get_table_load_order():
+            file_name = os.path.join(directory, '%s.%s' % (table_name, file_format))
+            if (table_names and table_name not in table_names) or not os.path.exists(file_name):
+                continue
+            with open(file_name, 'rb') as fileobj:
+                stats[table_name] = self.import_table(table_name, fileobj, file_format, progress)
+            if stats[table_name] is False:
+                return False
+        return stats
 
 
 class DBSchema:
@@ -119,6 +1318,28 @@ class DBSchema:
                     self.type = [column_def['type']]
                 if 'FOREIGN KEY' in self.type and 'foreign_key' in column_def:
                     self.foreign_key = column_def['foreign_key']
+                # Index determines whether a single column index is created; foreign keys are indexed by default
+                if 'index' in column_def:
+                    self.index = column_def['index']
+                else:
+                    self.index = hasattr(self, 'foreign_key')
+
+        class DBIndex:
+            def __init__(self, index_name, index_def):
+                self.name = index_name
+                if type(index_def['columns']) is list:
+                    self.columns = index_def['columns']
+                else:
+                    self.columns = [index_def['columns']]
+                if 'unique' in index_def:
+                    self.unique = index_def['unique']
+                else:
+                    self.unique = False
+                # Where makes the index partial, e.g. "year IS NOT NULL"
+                if 'where' in index_def:
+                    self.where = index_def['where']
+                else:
+                    self.where = None
 
         class JoinedTable:
             def __init__(self, table_name, table_def):
@@ -137,27 +1358,60 @@ class DBSchema:
                 else:
                     self.recursive_join = True
 
-        def __init__(self, table_name, table_def):
+        def __init__(self, table_name, table_def, column_order=None):
             self.name = table_name
             if 'label' in table_def:
                 self.label = table_def['label']
             else:
                 self.label = table_name.title()
-            self.columns = {}
+            columns = {}
             for column_name in table_def['columns']:
                 column_def = table_def['columns'][column_name]
-                self.columns[column_name] = self.DBColumn(column_name, column_def)
+                columns[column_name] = self.DBColumn(column_name, column_def)
+            # Columns keep the order a plain dict built from the config iterates in. The schema cache passes that
+            # order explicitly, since a dict rebuilt from the cache may iterate differently.
+            self.columns = collections.OrderedDict([(c, columns[c]) for c in column_order or columns])
             self.index_columns = []
             for column_name in self.columns:
                 column_def = self.columns[column_name]
                 if 'PRIMARY KEY' in column_def.type:
                     self.index_columns.append(column_name)
+            # Row Id Column is a single INTEGER primary key, which SQLite aliases to the rowid; add_table_row returns
+            # its value for the new row, and True for tables without one
+            self.row_id_column = None
+            if len(self.index_columns) == 1 and 'INTEGER' in self.columns[self.index_columns[0]].type:
+                self.row_id_column = self.index_columns[0]
+            self.indexes = {}
+            if 'indexes' in table_def:
+                for index_name in table_def['indexes']:
+                    self.indexes[index_name] = self.DBIndex(index_name, table_def['indexes'][index_name])
+            for column_name in self.columns:
+                if self.columns[column_name].index and column_name not in self.index_columns:
+                    leading_columns = [i.columns[0] for i in self.indexes.values() if not i.where]
+                    if column_name not in leading_columns:
+                        index_name = '%s_%s_idx' % (table_name, column_name)
+                        self.indexes[index_name] = self.DBIndex(index_name, {'columns': column_name})
+            # Unique Columns are the natural key used by upserts: the first non-partial unique index, or else the first
+            # column declared UNIQUE
+            self.unique_columns = None
+            for index_name in sorted(self.indexes):
+                if self.indexes[index_name].unique and not self.indexes[index_name].where:
+                    self.unique_columns = self.indexes[index_name].columns
+                    break
+            if not self.unique_columns:
+                for column_name in sorted(self.columns):
+                    if 'UNIQUE' in self.columns[column_name].type:
+                        self.unique_columns = [column_name]
+                        break
             if 'joined_tables' in table_def:
                 self.joined_tables = {}
                 for joined_table_name in table_def['joined_tables']:
                     joined_table_def = table_def['joined_tables'][joined_table_name]
                     self.joined_tables[joined_table_name] = self.JoinedTable(joined_table_name, joined_table_def)
 
+        def get_column_names(self, exclude_index=False):
+            return [c for c in self.columns if not exclude_index or c not in self.index_columns]
+
         def get_columns_string(self, exclude_index=False):
             ret_string = ""
             first_entry = True
@@ -170,14 +1424,72 @@ class DBSchema:
                         ret_string += ", " + column_name
             return ret_string
 
+        def get_create_index_command(self, index_name):
+            index = self.indexes[index_name]
+            command = "CREATE %sINDEX %s ON %s (%s)" % \
+                      ('UNIQUE ' if index.unique else '', index_name, self.name, ", ".join(index.columns))
+            if index.where:
+                command += " WHERE %s" % index.where
+            return command
+
+        def get_create_index_commands(self):
+            return [self.get_create_index_command(index_name) for index_name in sorted(self.indexes)]
+
+        def get_referenced_tables(self):
+            return sorted(set([c.foreign_key['table'] for c in self.columns.values() if 'FOREIGN KEY' in c.type]))
+
         def get_num_columns(self, exclude_index=False):
             num_columns = len(self.columns)
             if exclude_index:
                 num_columns -= len(self.index_columns)
             return num_columns
 
-    def __init__(self, schema_def):
-        self.tables = {}
+    def __init__(self, schema_def, schema_order=None):
+        # Every section other than tables holds backend settings, e.g. 'sqlite' or 'postgres'
+        self.settings = dict([(k, v) for k, v in schema_def.items() if k != 'tables'])
+        # Fingerprint of the table definitions, stored in the DB to skip verification while the schema is unchanged
+        self.fingerprint = hashlib.sha1(json.dumps(schema_def['tables'], sort_keys=True)).hexdigest()
+        self.compiled_statements = {}
+        self.cache_file_name = None
+        tables = {}
         for table_name in schema_def['tables']:
             table_def = schema_def['tables'][table_name]
-            self.tables[table_name] = self.DBTable(table_name, table_def)
+            column_order = schema_order['columns'][table_name] if schema_order else None
+            tables[table_name] = self.DBTable(table_name, table_def, column_order)
+        self.tables = collections.OrderedDict([(t, tables[t]) for t in (schema_order or {}).get('tables') or tables])
+        self.encoders = dict([(t, RowEncoder(self.tables[t])) for t in self.tables])
+        self.check_included_columns()
+
+    def check_included_columns(self):
+        # Every column named by an included_columns setting, on a foreign key or in joined_tables, must exist in the
+        # joined table. Joined tables outside the schema are selected whole and are not checked.
+        for table in self.tables.values():
+            settings = [(c.foreign_key['table'], c.foreign_key.get('included_columns'))
+                        for c in table.columns.values() if hasattr(c, 'foreign_key')]
+            settings += [(j.name, j.included_columns) for j in getattr(table, 'joined_tables', {}).values()]
+            for joined_table_name, included_columns in settings:
+                if joined_table_name not in self.tables:
+                    continue
+                joined_table = self.tables[joined_table_name]
+                for column_name in get_included_columns(joined_table, included_columns):
+                    if column_name not in joined_table.columns:
+                        print 'ERROR: included column %s of table %s is not a column of %s' % \
+                              (column_name, table.name, joined_table_name)
+                        raise ValueError('Unknown included column: %s.%s' % (joined_table_name, column_name))
+
+    def get_schema_order(self):
+        return {'tables': list(self.tables), 'columns': dict([(t, list(self.tables[t].columns)) for t in self.tables])}
+
+    def get_table_load_order(self):
+        # Table names ordered so that every table comes after the tables its foreign keys reference
+        load_order = []
+        remaining = sorted(self.tables)
+        while remaining:
+            ready = [t for t in remaining
+                     if not [r for r in self.tables[t].get_referenced_tables() if r in remaining and r != t]]
+            if not ready:
+                print 'ERROR: circular foreign keys between tables %s' % ", ".join(remaining)
+                return False
+            load_order.extend(ready)
+            remaining = [t for t in remaining if t not in ready]
+        return load_order
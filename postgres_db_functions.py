@@ -1,8 +1,24 @@
 import dbmangler_utils
+import collections
+import contextlib
+import csv
+import functools
+import itertools
+import threading
+import time
 import psycopg2.extras
 import psycopg2.errorcodes
-import json
-import pytoml
+import psycopg2.extensions
+import psycopg2.pool
+
+# Key of this backend's statements in the compiled schema cache, to be changed whenever a statement builder changes
+STATEMENTS_VERSION = 'postgres-4'
+
+# Types information_schema reports for the column types used in schema configs
+POSTGRES_TYPES = {'INTEGER': 'integer', 'INT': 'integer', 'SERIAL': 'integer', 'BIGINT': 'bigint',
+                  'SMALLINT': 'smallint', 'TEXT': 'character varying', 'REAL': 'real', 'FLOAT': 'double precision',
+                  'DOUBLE': 'double precision', 'BOOLEAN': 'boolean', 'DATE': 'date',
+                  'TIMESTAMP': 'timestamp without time zone'}
 
 
 def create_db(db_name, db_user, db_user_password=None, postgres_user='postgres', postgres_password=None):
@@ -20,69 +36,420 @@ def create_db(db_name, db_user, db_user_password=None, postgres_user='postgres',
     return True
 
 
-class DB:
-    def __init__(self, config_file_name='example_db_config.json'):
-        if config_file_name[-5:] == '.toml':
-            with open(config_file_name) as data_file:
-                db_config = pytoml.load(data_file)
+def _make_copy_field(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif isinstance(value, float):
+        # str() rounds floats to 12 significant digits, repr() keeps every digit
+        value = repr(value)
+    else:
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class IteratorFile:
+    # File-like wrapper around an iterator of strings, so COPY can stream rows without building the whole input
+    def __init__(self, iterator):
+        self.iterator = iterator
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            ret_string, self.buffer = self.buffer, ''
         else:
-            with open(config_file_name) as data_file:
-                db_config = json.load(data_file, object_hook=dbmangler_utils.decode_dict)
-        self.schema = dbmangler_utils.DBSchema(db_config)
-        self.db_name = 'testdb'
-        self.db_user = 'testuser'
-        self.db_password = 'password'
+            ret_string, self.buffer = self.buffer[:size], self.buffer[size:]
+        return ret_string
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class DBConnection(psycopg2.extensions.connection):
+    # Connection that carries its own cursors, transaction depth, prepared statements and the tables written in the
+    # open transaction, so that this state follows the connection in and out of the pool
+    def __init__(self, *args, **kwargs):
+        super(DBConnection, self).__init__(*args, **kwargs)
+        self.transaction_depth = 0
+        self.changed_tables = set()
+        self.prepared_statements = set()
+        self.statement_generation = 0
+        self.dict_cur = self.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.tuple_cur = self.cursor()
+
+    def reset_cursors(self):
+        self.dict_cur.close()
+        self.tuple_cur.close()
+        self.dict_cur = self.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        self.tuple_cur = self.cursor()
+
+
+def _with_connection(method):
+    # Holds one connection for the whole call, so that multi-statement methods never switch connections midway
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.connection():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DB(dbmangler_utils.DB):
+    placeholder = '%s'
+    array_in = True
+
+    def __init__(self, config_file_name='example_db_config.json', row_format='dict', pool_min_size=None,
+                 pool_max_size=None):
+        dbmangler_utils.DB.__init__(self, config_file_name, row_format)
+        self.statements = dbmangler_utils.get_compiled_statements(self.schema, STATEMENTS_VERSION,
+                                                                  self.compile_statements)
+        settings = self.schema.settings.get('postgres', {})
+        self.db_name = settings.get('db_name', 'testdb')
+        self.db_user = settings.get('db_user', 'testuser')
+        self.db_password = settings.get('db_password', 'password')
         self.conn_string = "dbname = '%s' user='%s' password='%s'" % (self.db_name, self.db_user, self.db_password)
+        if 'host' in settings:
+            self.conn_string += " host='%s'" % settings['host']
+        if 'port' in settings:
+            self.conn_string += " port='%s'" % settings['port']
         self.db_state = 'OK'
+        self.fetch_size = 2000
+        self.cursor_ids = itertools.count()
+        # Bumped when prepared statements are dropped; a connection whose generation is older drops its own before
+        # preparing again
+        self.statement_generation = 0
+        if 'slow_query_ms' in settings:
+            self.enable_instrumentation(settings['slow_query_ms'])
+
+        # Pooled mode checks a connection out of the pool around each call instead of sharing one connection
+        if pool_min_size is None:
+            pool_min_size = settings.get('pool_min_size', 0)
+        if pool_max_size is None:
+            pool_max_size = settings.get('pool_max_size', 0)
+        self.pool = None
+        self.pool_max_size = pool_max_size
+        self.pool_timeout = settings.get('pool_timeout', 30)
+        self.pool_ping = settings.get('pool_ping', False)
+        self.pool_condition = threading.Condition()
+        self.pool_in_use = 0
+        self.pool_stats = {'checkouts': 0, 'waits': 0, 'total_wait': 0.0, 'max_wait': 0.0, 'timeouts': 0,
+                           'broken_connections': 0}
+        self.local = threading.local()
         try:
-            self.con = psycopg2.connect(self.conn_string)
+            if pool_max_size:
+                self.pool = psycopg2.pool.ThreadedConnectionPool(pool_min_size, pool_max_size, self.conn_string,
+                                                                 connection_factory=DBConnection)
+            else:
+                self._con = psycopg2.connect(self.conn_string, connection_factory=DBConnection)
         except psycopg2.OperationalError:
             self.db_state = 'Faulted'
-        if self.db_state != 'Faulted':
-            self.cur = self.con.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-    def reset_cursor(self):
-        self.cur.close()
-        self.cur = self.con.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    @property
+    def con(self):
+        if not self.pool:
+            return self._con
+        return self.local.con
 
-    def run_select_command(self, command, values=None, return_list=False):
-        if not values:
-            try:
-                self.cur.execute(command)
-            except Exception as e:
-                print e
-                return False
-        else:
+    @property
+    def cur(self):
+        return self.con.dict_cur
+
+    @property
+    def tuple_cur(self):
+        return self.con.tuple_cur
+
+    def _get_current_connection(self):
+        # The connection this thread holds, or None, without checking one out
+        return getattr(self, '_con', None) if not self.pool else getattr(self.local, 'con', None)
+
+    def _is_healthy(self, con):
+        if con.closed or con.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if self.pool_ping:
             try:
-                self.cur.execute(command, values)
-            except Exception as e:
-                print e
+                con.tuple_cur.execute('SELECT 1')
+                con.rollback()
+            except psycopg2.Error:
                 return False
+        return True
 
-        if return_list:
-            return self.cur.fetchall()
-
-        res = []
-        for record in self.cur:
-            res.append(dict(record))
+    def acquire_connection(self):
+        if not self.pool:
+            return self._con
+        if getattr(self.local, 'con', None) is not None:
+            self.local.holds += 1
+            return self.local.con
+
+        start_time = time.time()
+        with self.pool_condition:
+            while self.pool_in_use >= self.pool_max_size:
+                remaining = self.pool_timeout - (time.time() - start_time)
+                if remaining <= 0:
+                    self.pool_stats['timeouts'] += 1
+                    raise psycopg2.pool.PoolError('timed out waiting for a pooled connection')
+                self.pool_condition.wait(remaining)
+            self.pool_in_use += 1
+            wait_time = time.time() - start_time
+            self.pool_stats['checkouts'] += 1
+            if wait_time > 0.001:
+                self.pool_stats['waits'] += 1
+            self.pool_stats['total_wait'] += wait_time
+            self.pool_stats['max_wait'] = max(self.pool_stats['max_wait'], wait_time)
 
-        return res
+        try:
+            con = self.pool.getconn()
+            while not self._is_healthy(con):
+                self.pool_stats['broken_connections'] += 1
+                self.pool.putconn(con, close=True)
+                con = self.pool.getconn()
+        except Exception:
+            with self.pool_condition:
+                self.pool_in_use -= 1
+                self.pool_condition.notify()
+            raise
+        con.transaction_depth = 0
+        con.changed_tables = set()
+        self.local.con = con
+        self.local.holds = 1
+        return con
+
+    def release_connection(self):
+        if not self.pool:
+            return
+        self.local.holds -= 1
+        if self.local.holds:
+            return
+        con = self.local.con
+        self.local.con = None
+        broken = bool(con.closed)
+        if not broken and con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                con.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken:
+            self.pool_stats['broken_connections'] += 1
+        self.pool.putconn(con, close=broken)
+        with self.pool_condition:
+            self.pool_in_use -= 1
+            self.pool_condition.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        con = self.acquire_connection()
+        try:
+            yield con
+        finally:
+            self.release_connection()
+
+    def get_pool_stats(self):
+        with self.pool_condition:
+            stats = dict(self.pool_stats)
+            stats['in_use'] = self.pool_in_use
+            stats['max_size'] = self.pool_max_size
+        return stats
+
+    @_with_connection
+    def reset_cursor(self):
+        self.con.reset_cursors()
+
+    def _convert_rows(self, cur, rows, row_format):
+        # DictCursor rows are used for the dict and row formats, plain cursor tuples for tuple and record
+        if row_format == 'dict':
+            return [dict(row) for row in rows]
+        if row_format == 'record':
+            record_class = self.get_record_class(cur.description)
+            return [record_class(row) for row in rows]
+        return rows
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Commits when the outermost block exits and rolls back on exception; nested blocks use savepoints. The
+        # connection is held for the whole block.
+        with self.connection():
+            savepoint = 'dbmangler_savepoint_%s' % self.con.transaction_depth
+            if self.con.transaction_depth:
+                self.cur.execute('SAVEPOINT %s' % savepoint)
+            self.con.transaction_depth += 1
+            try:
+                yield self
+            except Exception:
+                self.con.transaction_depth -= 1
+                if self.con.transaction_depth:
+                    self.cur.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+                    self.cur.execute('RELEASE SAVEPOINT %s' % savepoint)
+                else:
+                    self.con.rollback()
+                    self.con.changed_tables.clear()
+                raise
+            self.con.transaction_depth -= 1
+            if self.con.transaction_depth:
+                self.cur.execute('RELEASE SAVEPOINT %s' % savepoint)
+            else:
+                try:
+                    self.con.commit()
+                except psycopg2.Error:
+                    self.con.changed_tables.clear()
+                    raise
+                self._tables_committed(self.con)
+
+    @_with_connection
+    def run_select_command(self, command, values=None, return_list=False, row_format=None):
+        row_format = row_format or self.row_format
+        if return_list:
+            row_format = 'row'
+        if row_format in ('dict', 'row'):
+            cur = self.cur
+        else:
+            cur = self.tuple_cur
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
+        try:
+            if not values:
+                cur.execute(command)
+            else:
+                cur.execute(command, values)
+        except Exception as e:
+            print e
+            # Outside transaction() the failed statement would leave the connection aborted for every later call
+            if not self.con.transaction_depth:
+                self.con.rollback()
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            if self.con.transaction_depth:
+                raise
+            return False
 
-    def run_edit_command(self, command, values=None):
+        rows = self._convert_rows(cur, cur.fetchall(), row_format)
+        if self.instrumentation:
+            self.instrumentation.after(command, values, start, len(rows))
+
+        return rows
+
+    def iter_select_command(self, command, values=None, fetch_size=None, row_format=None, chunked=False):
+        # Runs the query on a named server-side cursor and returns a generator that transfers fetch_size rows per
+        # round trip, yielding single rows or, if chunked is set, each fetched list of rows. Prepared statements
+        # cannot be declared as cursors, so the plain statement text is expected. The cursor is declared WITH HOLD,
+        # so writes committed while iterating do not close it; the rows left at such a commit are materialized.
+        row_format = row_format or self.row_format
+        self.acquire_connection()
+        cursor_name = 'dbmangler_cursor_%s' % next(self.cursor_ids)
+        if row_format in ('dict', 'row'):
+            cur = self.con.cursor(name=cursor_name, cursor_factory=psycopg2.extras.DictCursor, withhold=True)
+        else:
+            cur = self.con.cursor(name=cursor_name, withhold=True)
+        cur.itersize = fetch_size or self.fetch_size
+        # Timed until the last row is fetched, since a named cursor transfers the rows while they are consumed
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
+        try:
+            if not values:
+                cur.execute(command)
+            else:
+                cur.execute(command, values)
+        except Exception as e:
+            print e
+            cur.close()
+            in_transaction = self.con.transaction_depth
+            if not in_transaction:
+                self.con.rollback()
+            self.release_connection()
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            if in_transaction:
+                raise
+            return False
+        finished = None
+        if self.instrumentation:
+            finished = functools.partial(self.instrumentation.after, command, values, start)
+
+        # The generator is started here, so that closing or dropping it, even before it is iterated, runs its
+        # finally block and releases the cursor and the connection
+        chunks = self._iter_cursor_chunks(cur, row_format, finished)
+        next(chunks)
+        if chunked:
+            return chunks
+        return self._iter_cursor(chunks)
+
+    def _iter_cursor(self, chunks):
+        for rows in chunks:
+            for row in rows:
+                yield row
+
+    def _iter_cursor_chunks(self, cur, row_format, finished=None):
+        # Yields None once before the rows. finished(num_rows) is called once the cursor is exhausted or the
+        # generator is closed.
+        num_rows = 0
+        try:
+            yield None
+            while True:
+                rows = cur.fetchmany(cur.itersize)
+                if not rows:
+                    break
+                num_rows += len(rows)
+                yield self._convert_rows(cur, rows, row_format)
+        finally:
+            cur.close()
+            if not self.con.transaction_depth:
+                self.con.commit()
+            self.release_connection()
+            if finished:
+                finished(num_rows)
+
+    @_with_connection
+    def run_edit_command(self, command, values=None, returning=False):
+        row = None
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
         try:
             self.cur.execute(command, values)
+            if returning:
+                row = self.cur.fetchone()
         except Exception as e:
             print e
+            if not self.con.transaction_depth:
+                self.con.rollback()
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            # Inside transaction() the error has to reach the block: the transaction is aborted and can only be
+            # rolled back
+            if self.con.transaction_depth:
+                raise
             return False
+        if self.instrumentation:
+            self.instrumentation.after(command, values, start, self.cur.rowcount)
 
-        self.con.commit()
+        if not self.con.transaction_depth:
+            self.con.commit()
+
+        if returning:
+            return row
 
         return True
 
+    @_with_connection
+    def explain_command(self, command, values=None):
+        # Runs in a savepoint so that a failing EXPLAIN cannot abort the transaction of the explained statement
+        cur = self.con.cursor()
+        try:
+            cur.execute('SAVEPOINT dbmangler_explain')
+            cur.execute('EXPLAIN ' + command, values)
+            plan = "\n".join([row[0] for row in cur.fetchall()])
+            cur.execute('RELEASE SAVEPOINT dbmangler_explain')
+            return plan
+        except psycopg2.Error as e:
+            cur.execute('ROLLBACK TO SAVEPOINT dbmangler_explain')
+            return str(e)
+        finally:
+            cur.close()
+
     def get_db_schema(self):
 
         res = self.run_select_command("SELECT table_name, column_name, data_type FROM information_schema.columns "
-                                      "WHERE table_schema = 'public' AND table_catalog = %s", (self.db_name,))
+                                      "WHERE table_schema = 'public' AND table_catalog = %s", (self.db_name,),
+                                      row_format='dict')
         if not res:
             return False
 
@@ -98,50 +465,39 @@ class DB:
             first_column = True
             foreign_key_in_table = []
             primary_key_in_table = []
-            alter_tables_script_line = None
             for column_name in self.schema.tables[table_name].columns:
                 column_info = self.schema.tables[table_name].columns[column_name]
                 if not first_column:
                     create_tables_script_line += ", "
                 else:
                     first_column = False
-                temp_column_info_type = list(column_info.type)
                 if 'PRIMARY KEY' in column_info.type:
                     primary_key_in_table.append(column_name)
                 if 'FOREIGN KEY' in column_info.type:
-                    temp_column_info_type.remove('FOREIGN KEY')
                     foreign_key_in_table.append(column_name)
-                if 'TEXT' in column_info.type:
-                    temp_column_info_type.remove('TEXT')
-                    temp_column_info_type.append('character varying')
-                if 'AUTOINCREMENT' in column_info.type:
-                    temp_column_info_type = ['serial', 'NOT NULL']
-                column_type_string = " ".join(temp_column_info_type)
-                create_tables_script_line += "%s %s" % (column_name, column_type_string)
+                create_tables_script_line += "%s %s" % (column_name, self.make_column_type(column_info))
             if primary_key_in_table:
                 for column_name in primary_key_in_table:
                     create_tables_script_line += ", CONSTRAINT %s_pkey PRIMARY KEY (%s)" % (table_name, column_name)
-            if foreign_key_in_table:
-                for column_name in foreign_key_in_table:
-                    column_info = self.schema.tables[table_name].columns[column_name]
-                    alter_tables_script_line = "ALTER TABLE %s ADD CONSTRAINT %s_%s_fkey FOREIGN KEY (%s) " \
-                                               "REFERENCES %s (%s) MATCH SIMPLE ON UPDATE NO ACTION ON DELETE NO ACTION" % \
-                                               (table_name, table_name, column_name, column_name,
-                                                column_info.foreign_key['table'], column_name)
+            for column_name in foreign_key_in_table:
+                alter_tables_array.append(self.make_foreign_key_command(table_name, column_name))
 
             create_tables_array.append(create_tables_script_line)
-            if alter_tables_script_line:
-                alter_tables_array.append(alter_tables_script_line)
 
-        create_tables_script = "); ".join(create_tables_array)
+        create_tables_script = "); ".join(create_tables_array) + "); "
         if alter_tables_array:
             alter_tables_script = "; ".join(alter_tables_array)
-            create_tables_script += "); " + alter_tables_script + "; "
+            create_tables_script += alter_tables_script + "; "
+        for table_name in self.schema.tables:
+            for create_index_command in self.schema.tables[table_name].get_create_index_commands():
+                create_tables_script += create_index_command + "; "
 
         if not return_script and not return_array:
-            if not self.run_edit_command(create_tables_script):
-                self.con.rollback()
-                return False
+            with self.connection():
+                self.deallocate_prepared_statements()
+                if not self.run_edit_command(create_tables_script):
+                    self.con.rollback()
+                    return False
 
             return True
         elif return_script:
@@ -149,45 +505,206 @@ class DB:
         elif return_array:
             return create_tables_array
 
-    def check_schema(self):
-        pass
+    def get_schema_changes(self, db_tables=None):
+        # Statements that bring the DB up to date with the schema, or False when the DB differs in a way that
+        # cannot be migrated, such as a changed column type. Foreign keys are added once all tables exist.
+        if db_tables is None:
+            db_tables = self.make_schema_object()
+            if db_tables is False:
+                return False
+
+        missing_tables, missing_columns, missing_indexes, problems = \
+            dbmangler_utils.diff_schema(self.schema, db_tables, self.get_column_type)
+        if problems:
+            for problem in problems:
+                print problem
+            return False
+
+        create_tables = dict(zip(self.schema.tables, self.create_schema(return_array=True)))
+        changes = [create_tables[t] + ")" for t in missing_tables]
+        foreign_keys = []
+        for table_name in missing_tables:
+            table = self.schema.tables[table_name]
+            foreign_keys += [(table_name, c) for c in table.columns if 'FOREIGN KEY' in table.columns[c].type]
+            missing_indexes += [(table_name, i) for i in sorted(table.indexes)]
+        for table_name, column_name in missing_columns:
+            column_info = self.schema.tables[table_name].columns[column_name]
+            changes.append("ALTER TABLE %s ADD COLUMN %s %s" %
+                           (table_name, column_name, self.make_column_type(column_info)))
+            if 'FOREIGN KEY' in column_info.type:
+                foreign_keys.append((table_name, column_name))
+        for table_name, column_name in foreign_keys:
+            changes.append(self.make_foreign_key_command(table_name, column_name))
+        for table_name, index_name in missing_indexes:
+            changes.append(self.schema.tables[table_name].get_create_index_command(index_name))
+
+        return changes
+
+    def migrate_schema(self, changes):
+        # Applies the changes and stores the schema fingerprint in one transaction
+        with self.connection():
+            try:
+                with self.transaction():
+                    for command in changes:
+                        print "Migrating schema: %s" % command
+                        self.cur.execute(command)
+                    self.cur.execute("CREATE TABLE IF NOT EXISTS %s (key character varying PRIMARY KEY, "
+                                     "value character varying)" % dbmangler_utils.SCHEMA_META_TABLE)
+                    self.cur.execute("INSERT INTO %s (key, value) VALUES ('schema_fingerprint', %%s) "
+                                     "ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value" %
+                                     dbmangler_utils.SCHEMA_META_TABLE, [self.schema.fingerprint])
+            except psycopg2.Error as e:
+                print e
+                return False
+            # Prepared SELECT * statements would no longer match the altered tables
+            self.deallocate_prepared_statements()
+
+        for table_name in self.schema.tables:
+            self.table_changed(table_name)
+        return True
+
+    def get_schema_fingerprint(self):
+        rows = self.run_select_command("SELECT to_regclass(%s) IS NOT NULL",
+                                       ['public.%s' % dbmangler_utils.SCHEMA_META_TABLE], row_format='tuple')
+        if not rows or not rows[0][0]:
+            return None
+        rows = self.run_select_command("SELECT value FROM %s WHERE key = 'schema_fingerprint'" %
+                                       dbmangler_utils.SCHEMA_META_TABLE, row_format='tuple')
+        if not rows:
+            return None
+
+        return rows[0][0]
+
+    def get_column_type(self, column_info):
+        # The type information_schema reports for a schema column, None when there is no known mapping
+        if 'AUTOINCREMENT' in column_info.type:
+            return 'integer'
+        return POSTGRES_TYPES.get(column_info.type[0].upper())
+
+    def make_column_type(self, column_info):
+        if 'AUTOINCREMENT' in column_info.type:
+            return 'serial NOT NULL'
+        column_type = [t for t in column_info.type if t != 'FOREIGN KEY']
+        if 'TEXT' in column_type:
+            column_type[column_type.index('TEXT')] = 'character varying'
+        return " ".join(column_type)
+
+    def make_foreign_key_command(self, table_name, column_name):
+        column_info = self.schema.tables[table_name].columns[column_name]
+        return "ALTER TABLE %s ADD CONSTRAINT %s_%s_fkey FOREIGN KEY (%s) REFERENCES %s (%s) MATCH SIMPLE " \
+               "ON UPDATE NO ACTION ON DELETE NO ACTION" % \
+               (table_name, table_name, column_name, column_name, column_info.foreign_key['table'], column_name)
 
     def make_schema_object(self):
-        pass
+        # Reads the tables, columns and indexes from the catalog as
+        # {table name: {'columns': [{'name', 'type', 'not_null', 'default', 'primary_key'}],
+        #               'indexes': [{'name', 'columns', 'unique'}]}}
+        columns = self.run_select_command(
+            "SELECT table_name, column_name, data_type, is_nullable, column_default FROM information_schema.columns "
+            "WHERE table_schema = 'public' AND table_name != %s ORDER BY table_name, ordinal_position",
+            [dbmangler_utils.SCHEMA_META_TABLE], row_format='dict')
+        indexes = self.run_select_command(
+            "SELECT t.relname AS table_name, i.relname AS index_name, ix.indisunique AS is_unique, "
+            "ix.indisprimary AS is_primary, array_agg(a.attname::text ORDER BY k.n) AS column_names "
+            "FROM pg_index ix JOIN pg_class i ON i.oid = ix.indexrelid JOIN pg_class t ON t.oid = ix.indrelid "
+            "JOIN pg_namespace ns ON ns.oid = t.relnamespace "
+            "CROSS JOIN LATERAL unnest(ix.indkey) WITH ORDINALITY AS k(attnum, n) "
+            "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum "
+            "WHERE ns.nspname = 'public' GROUP BY t.relname, i.relname, ix.indisunique, ix.indisprimary",
+            row_format='dict')
+        if columns is False or indexes is False:
+            return False
 
+        db_tables = {}
+        primary_keys = set()
+        for i in indexes:
+            if i['table_name'] == dbmangler_utils.SCHEMA_META_TABLE:
+                continue
+            db_tables.setdefault(i['table_name'], {'columns': [], 'indexes': []})
+            db_tables[i['table_name']]['indexes'].append({'name': i['index_name'], 'unique': i['is_unique'],
+                                                          'columns': i['column_names']})
+            if i['is_primary']:
+                primary_keys.update([(i['table_name'], c) for c in i['column_names']])
+        for c in columns:
+            db_tables.setdefault(c['table_name'], {'columns': [], 'indexes': []})
+            db_tables[c['table_name']]['columns'].append({'name': c['column_name'], 'type': c['data_type'],
+                                                          'not_null': c['is_nullable'] == 'NO',
+                                                          'default': c['column_default'],
+                                                          'primary_key': (c['table_name'], c['column_name']) in
+                                                          primary_keys})
+
+        return db_tables
+
+    @_with_connection
     def drop_db_tables(self):
-        drop_tables_script = ""
+        drop_tables_script = "DROP TABLE IF EXISTS %s; " % dbmangler_utils.SCHEMA_META_TABLE
         for t in self.schema.tables:
             drop_tables_script += "DROP TABLE IF EXISTS %s; " % t
+            self.table_changed(t)
+        self.deallocate_prepared_statements()
         if not self.run_edit_command(drop_tables_script):
             self.con.rollback()
             return False
 
         return True
 
-    def make_sorted_list_from_dict(self, data, table_name, prefix=''):
-        ret_list = []
-        for c in self.schema.tables[table_name].columns:
-            if c not in self.schema.tables[table_name].index_columns:
-                col_label = prefix + c
-                if col_label in data:
-                    if type(data[col_label]) is str:
-                        ret_list.append(data[col_label])
-                    elif type(data[col_label]) is list:
-                        if type(data[col_label][0]) is str:
-                            ret_list.append(data[col_label][0])
-                        else:
-                            return False
-                    else:
-                        return False
-                else:
-                    return False
-        return ret_list
+    def compile_statements(self):
+        statements = {}
+        for table_name in self.schema.tables:
+            statements[table_name] = dbmangler_utils.TableStatements(
+                select=self.make_simple_select_command(table_name), insert=self.make_insert_command(table_name),
+                update=self.make_update_command(table_name), delete=self.make_delete_command(table_name),
+                upsert=self.make_upsert_command(table_name),
+                delete_by_key=self.make_delete_by_key_command(table_name))
+        return statements
+
+    @_with_connection
+    def get_prepared_command(self, table_name, statement_type):
+        # Returns an EXECUTE command for one of the compiled table statements, preparing it on this connection the
+        # first time it is used. Falls back to the plain statement if it cannot be prepared.
+        command = getattr(self.statements[table_name], statement_type)
+        statement_name = 'dbmangler_%s_%s' % (table_name, statement_type)
+        if self.con.statement_generation != self.statement_generation:
+            if not self._deallocate_connection_statements():
+                return command
+        if statement_name not in self.con.prepared_statements:
+            prepare_command = "PREPARE %s AS %s" % \
+                              (statement_name, dbmangler_utils.make_numbered_placeholders(command, '%s'))
+            try:
+                with self.transaction():
+                    self.cur.execute(prepare_command)
+            except Exception as e:
+                print e
+                return command
+            self.con.prepared_statements.add(statement_name)
+        num_values = command.count('%s')
+        if not num_values:
+            return "EXECUTE %s" % statement_name
+        return "EXECUTE %s (%s)" % (statement_name, dbmangler_utils.make_list_string_from_char('%s', num_values))
+
+    @_with_connection
+    def deallocate_prepared_statements(self):
+        # Drops the prepared statements of this connection now and those of the other pooled connections the next
+        # time they prepare one, since their plans may no longer match the tables
+        self.statement_generation += 1
+        return self._deallocate_connection_statements()
+
+    def _deallocate_connection_statements(self):
+        if self.con.prepared_statements:
+            if not self.run_edit_command("DEALLOCATE ALL"):
+                return False
+            self.con.prepared_statements = set()
+        self.con.statement_generation = self.statement_generation
+        return True
 
-    def make_simple_select_command(self, table_name):
-        select_command = "SELECT * FROM %s " % table_name
+    def make_simple_select_command(self, table_name, columns=None, additional_joins=None):
+        # Projects the given base table columns, or all of them, and the included columns of the joined tables
         if table_name not in self.schema.tables:
             return False
+        select_list = dbmangler_utils.make_select_list(self.schema, table_name, columns, additional_joins)
+        if not select_list:
+            return False
+        select_command = "SELECT %s FROM %s " % (select_list, table_name)
         for column_name in self.schema.tables[table_name].columns:
             column_info = self.schema.tables[table_name].columns[column_name]
             if 'FOREIGN KEY' in column_info.type:
@@ -196,8 +713,8 @@ class DB:
                                    table_name, column_name, column_info.foreign_key['table'], column_name)
         return select_command
 
-    def make_complex_select_command(self, table_name, additional_joins):
-        select_command = self.make_simple_select_command(table_name)
+    def make_complex_select_command(self, table_name, additional_joins, columns=None):
+        select_command = self.make_simple_select_command(table_name, columns, additional_joins)
         if not select_command:
             return False
         for j in additional_joins:
@@ -214,8 +731,22 @@ class DB:
         num_columns = self.schema.tables[table_name].get_num_columns(exclude_index=True)
         insert_command += dbmangler_utils.make_list_string_from_char('?', num_columns)
         insert_command += ")"
+        if self.schema.tables[table_name].row_id_column:
+            insert_command += " RETURNING %s" % self.schema.tables[table_name].row_id_column
         return insert_command.replace('?', '%s')
 
+    def make_upsert_command(self, table_name):
+        # The no-op update on conflict makes RETURNING produce the existing row as well as a newly inserted one
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].unique_columns:
+            return False
+        table = self.schema.tables[table_name]
+        upsert_command = "INSERT INTO %s (%s) VALUES(%s) " % \
+                         (table_name, table.get_columns_string(exclude_index=True),
+                          dbmangler_utils.make_list_string_from_char('%s', table.get_num_columns(exclude_index=True)))
+        upsert_command += "ON CONFLICT (%s) DO UPDATE SET %s = EXCLUDED.%s RETURNING *" % \
+                          (", ".join(table.unique_columns), table.unique_columns[0], table.unique_columns[0])
+        return upsert_command
+
     def make_update_command(self, table_name):
         update_command = "UPDATE %s SET " % table_name
         first_entry = True
@@ -240,6 +771,23 @@ class DB:
 
         return update_command.replace('?', '%s')
 
+    def make_key_where_clause(self, table_name):
+        return " AND ".join(["%s=?" % c for c in self.schema.tables[table_name].index_columns])
+
+    def make_delete_by_key_command(self, table_name):
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].index_columns:
+            return False
+        delete_command = "DELETE FROM %s WHERE %s" % (table_name, self.make_key_where_clause(table_name))
+        return delete_command.replace('?', '%s')
+
+    def make_update_by_key_command(self, table_name, column_names):
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].index_columns:
+            return False
+        update_command = "UPDATE %s SET %s WHERE %s" % \
+                         (table_name, ", ".join(["%s=?" % c for c in column_names]),
+                          self.make_key_where_clause(table_name))
+        return update_command.replace('?', '%s')
+
     def make_delete_command(self, table_name):
         delete_command = "DELETE FROM %s WHERE " % table_name
         first_entry = True
@@ -255,75 +803,217 @@ class DB:
 
         return delete_command.replace('?', '%s')
 
-    def get_subset_table_rows(self, table_name, conditions, additional_joins=None, order_and_limit=None):
+    def run_cached_select_command(self, command, values, tables):
+        # Serves the query from the query cache, when enabled, as long as none of the tables it reads has changed.
+        # Inside a transaction the cache is bypassed, since the rows read there may be rolled back.
 
-        if not additional_joins:
-            select_command = self.make_simple_select_command(table_name)
-        else:
-            select_command = self.make_complex_select_command(table_name, additional_joins)
-        first_item = True
-        for c in conditions:
-            if first_item:
-                first_item = False
-                select_command += 'WHERE '
-            else:
-                select_command += 'AND '
-            if type(c[c.keys()[0]]) is list:
-                select_command += "%s = '%s' " % (c.keys()[0], c[c.keys()[0]][0])
-            elif type(c[c.keys()[0]]) is str or type(c[c.keys()[0]]) is int:
-                select_command += "%s = '%s' " % (c.keys()[0], c[c.keys()[0]])
-
-        if order_and_limit:
-            if 'order' in order_and_limit.keys():
-                first_item = True
-                for o in order_and_limit['order']:
-                    if first_item:
-                        first_item = False
-                        select_command += 'ORDER BY '
-                    else:
-                        select_command += ', '
-                    select_command += '%s ' % o
-            if 'limit' in order_and_limit.keys():
-                select_command += 'LIMIT %s ' % order_and_limit['limit']
+        query_cache = self.query_cache if not self.in_transaction() else None
+        if query_cache:
+            cache_key = query_cache.make_key(self.row_format, command, values)
+            rows = query_cache.get(cache_key)
+            if rows is not None:
+                return rows
+            versions = query_cache.get_versions(tables)
+
+        rows = self.run_select_command(command, values)
+        if rows is False:
+            return False
+        if query_cache:
+            return query_cache.put(cache_key, versions, rows)
 
-        return self.run_select_command(select_command)
+        return rows
 
+    @_with_connection
     def get_all_table_rows(self, table_name):
 
-        select_command = self.make_simple_select_command(table_name)
+        if table_name not in self.statements:
+            return False
 
-        return self.run_select_command(select_command)
+        select_command = self.get_prepared_command(table_name, 'select')
 
-    def _check_data(self, table_name, data):
+        return self.run_cached_select_command(select_command, None, self.get_select_dependencies(table_name))
 
-        if table_name not in self.schema.tables:
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def add_table_row(self, table_name, data):
+
+        data = self._check_data(table_name, data)
+
+        if not data:
             return False
 
-        if len(data) < self.schema.tables[table_name].get_num_columns(exclude_index=True):
-            print 'ERROR: number of columns and items in data do not match'
+        insert_command = self.get_prepared_command(table_name, 'insert')
+        if not self.schema.tables[table_name].row_id_column:
+            return self.run_edit_command(insert_command, data)
+
+        row = self.run_edit_command(insert_command, data, returning=True)
+        if not row:
             return False
 
-        if type(data) is dict:
-            data = self.make_sorted_list_from_dict(data, table_name)
-            if not data:
-                print 'ERROR: could not make list from data dict'
-                return False
+        return row[0]
 
-        return data
+    def _get_key_values(self, table_name, data):
+        column_names = self.schema.tables[table_name].get_column_names(exclude_index=True)
+        return [data[column_names.index(c)] for c in self.schema.tables[table_name].unique_columns]
 
-    def add_table_row(self, table_name, data):
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def upsert_table_row(self, table_name, data):
+        # Inserts the row unless a row with the same unique key already exists, and returns the stored row either way,
+        # in a single round trip
 
         data = self._check_data(table_name, data)
 
         if not data:
             return False
 
-        insert_command = self.make_insert_command(table_name)
-        if not self.run_edit_command(insert_command, data):
+        if not self.statements[table_name].upsert:
+            print 'ERROR: table %s has no unique columns' % table_name
+            return False
+
+        row = self.run_edit_command(self.get_prepared_command(table_name, 'upsert'), data, returning=True)
+        if not row:
+            return False
+
+        return self._convert_rows(self.cur, [row], self.row_format)[0]
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def get_row_ids(self, table_name, rows, batch_size=1000):
+        # Resolves the unique key of every row to its primary key, inserting the rows that do not exist yet. Returns a
+        # dict of key (a single value, or a tuple for composite keys) to primary key.
+        if table_name not in self.schema.tables:
+            return False
+
+        table = self.schema.tables[table_name]
+        if not self.statements[table_name].upsert or len(table.index_columns) != 1:
+            print 'ERROR: table %s needs unique columns and a single primary key' % table_name
+            return False
+
+        insert_command = "INSERT INTO %s (%s) VALUES %%s ON CONFLICT (%s) DO NOTHING" % \
+                         (table_name, table.get_columns_string(exclude_index=True), ", ".join(table.unique_columns))
+        select_command = "SELECT %s, %s FROM %s WHERE (%s) IN (VALUES %%s)" % \
+                         (table.index_columns[0], ", ".join(table.unique_columns), table_name,
+                          ", ".join(table.unique_columns))
+        row_ids = {}
+        for batch in dbmangler_utils.chunk_iterable(rows, batch_size):
+            batch_data = self.schema.encoders[table_name].encode_many(batch)[0]
+            if not batch_data:
+                continue
+            keys = list(set([tuple(self._get_key_values(table_name, d)) for d in batch_data]))
+            try:
+                with self.transaction():
+                    psycopg2.extras.execute_values(self.tuple_cur, insert_command, batch_data, page_size=batch_size)
+                    found_rows = psycopg2.extras.execute_values(self.tuple_cur, select_command, keys,
+                                                                page_size=batch_size, fetch=True)
+            except Exception as e:
+                print e
+                return False
+            for row in found_rows:
+                if len(row) == 2:
+                    row_ids[row[1]] = row[0]
+                else:
+                    row_ids[tuple(row[1:])] = row[0]
+
+        return row_ids
+
+    def _make_copy_lines(self, table_name, rows, results):
+        for row in rows:
+            data = self._check_data(table_name, row)
+            if not data:
+                results['rows_rejected'] += 1
+                continue
+            results['rows_added'] += 1
+            yield '\t'.join([_make_copy_field(d) for d in data]) + '\n'
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def copy_table_rows(self, table_name, rows):
+        # Streams every row through a single COPY; the load is all or nothing
+        if table_name not in self.schema.tables:
+            return False
+
+        copy_command = "COPY %s (%s) FROM STDIN" % \
+                       (table_name, self.schema.tables[table_name].get_columns_string(exclude_index=True))
+        results = {'rows_added': 0, 'rows_rejected': 0, 'failed_batches': []}
+
+        try:
+            with self.transaction():
+                self.cur.copy_expert(copy_command, IteratorFile(self._make_copy_lines(table_name, rows, results)))
+        except Exception as e:
+            print e
+            return False
+
+        return results
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def add_table_rows(self, table_name, rows, batch_size=1000):
+        # Each batch is sent as one multi-row VALUES insert; if a batch fails, its rows are retried one at a time
+        # so that only the bad rows are rejected
+        if table_name not in self.schema.tables:
+            return False
+
+        insert_command = "INSERT INTO %s (%s) VALUES %%s" % \
+                         (table_name, self.schema.tables[table_name].get_columns_string(exclude_index=True))
+        row_insert_command = self.get_prepared_command(table_name, 'insert')
+        results = {'rows_added': 0, 'rows_rejected': 0, 'failed_batches': []}
+
+        for batch_number, batch in enumerate(dbmangler_utils.chunk_iterable(rows, batch_size)):
+            batch_data, num_rejected = self.schema.encoders[table_name].encode_many(batch)
+            results['rows_rejected'] += num_rejected
+            if not batch_data:
+                continue
+            try:
+                with self.transaction():
+                    psycopg2.extras.execute_values(self.cur, insert_command, batch_data, page_size=batch_size)
+                results['rows_added'] += len(batch_data)
+                continue
+            except Exception as e:
+                print 'ERROR: batch %s failed, retrying row by row: %s' % (batch_number, e)
+                results['failed_batches'].append((batch_number, str(e)))
+            for data in batch_data:
+                try:
+                    with self.transaction():
+                        self.cur.execute(row_insert_command, data)
+                    results['rows_added'] += 1
+                except Exception as e:
+                    print e
+                    results['rows_rejected'] += 1
+
+        return results
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def add_encoded_rows(self, table_name, column_names, batch_data):
+        # Writes rows already encoded for column_names, e.g. by a RowEncoder in another process, with one COPY in one
+        # transaction
+        if table_name not in self.schema.tables:
+            return False
+
+        copy_command = "COPY %s (%s) FROM STDIN" % (table_name, ", ".join(column_names))
+        lines = ('\t'.join([_make_copy_field(d) for d in data]) + '\n' for data in batch_data)
+        try:
+            with self.transaction():
+                self.cur.copy_expert(copy_command, IteratorFile(lines))
+                self._reset_sequences(table_name, column_names)
+        except psycopg2.Error as e:
+            print e
             return False
 
         return True
 
+    def _reset_sequences(self, table_name, column_names):
+        # Moves the serial sequences past primary keys that were written explicitly
+        table = self.schema.tables[table_name]
+        for column_name in table.index_columns:
+            if column_name in column_names and 'AUTOINCREMENT' in table.columns[column_name].type:
+                self.cur.execute("SELECT setval(pg_get_serial_sequence(%%s, %%s), COALESCE(MAX(%s), 1), "
+                                 "MAX(%s) IS NOT NULL) FROM %s" % (column_name, column_name, table_name),
+                                 [table_name, column_name])
+
+    @dbmangler_utils.changes_table
+    @_with_connection
     def delete_table_row(self, table_name, data):
 
         data = self._check_data(table_name, data)
@@ -331,12 +1021,14 @@ class DB:
         if not data:
             return False
 
-        delete_command = self.make_delete_command(table_name)
+        delete_command = self.get_prepared_command(table_name, 'delete')
         if not self.run_edit_command(delete_command, data):
             return False
 
         return True
 
+    @dbmangler_utils.changes_table
+    @_with_connection
     def update_table_row(self, table_name, old_data, new_data):
 
         new_data_list = self._check_data(table_name, new_data)
@@ -345,15 +1037,99 @@ class DB:
             return False
         data = new_data_list+old_data_list  # type: list
 
-        update_command = self.make_update_command(table_name)
+        update_command = self.get_prepared_command(table_name, 'update')
 
         if not self.run_edit_command(update_command, data):
             return False
 
         return True
 
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def update_row_by_key(self, table_name, key, changes):
+        # Updates only the changed columns of the row with the given primary key
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        row = dict(changes)
+        row.update(zip(self.schema.tables[table_name].index_columns, self._get_key_list(table_name, key)))
+        key_row = self._split_key_row(table_name, row)
+        if not key_row or not key_row[0]:
+            return False
+
+        return self.run_edit_command(self._get_update_by_key_command(table_name, key_row[0]), key_row[1])
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def update_rows_by_key(self, table_name, rows):
+        # Each row is a dict of the primary key plus the changed columns. Rows changing the same columns are sent
+        # together, and all of them are written in one transaction.
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        grouped_rows = collections.OrderedDict()
+        for row in rows:
+            key_row = self._split_key_row(table_name, row)
+            if not key_row or not key_row[0]:
+                return False
+            grouped_rows.setdefault(key_row[0], []).append(key_row[1])
+
+        try:
+            with self.transaction():
+                for column_names in grouped_rows:
+                    update_command = self._get_update_by_key_command(table_name, column_names)
+                    psycopg2.extras.execute_batch(self.cur, update_command, grouped_rows[column_names])
+        except Exception as e:
+            print e
+            return False
+
+        return True
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def delete_row_by_key(self, table_name, key):
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        delete_command = self.get_prepared_command(table_name, 'delete_by_key')
+
+        return self.run_edit_command(delete_command, self._get_key_list(table_name, key))
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def delete_rows_by_key(self, table_name, keys, batch_size=500):
+        # Deletes many rows by primary key with one statement per batch, all in one transaction
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        index_columns = self.schema.tables[table_name].index_columns
+        try:
+            with self.transaction():
+                for batch in dbmangler_utils.chunk_iterable(keys, batch_size):
+                    key_lists = [self._get_key_list(table_name, k) for k in batch]
+                    if len(index_columns) == 1:
+                        self.cur.execute("DELETE FROM %s WHERE %s = ANY(%%s)" % (table_name, index_columns[0]),
+                                         ([k[0] for k in key_lists],))
+                    else:
+                        delete_command = "DELETE FROM %s WHERE (%s) IN (VALUES %%s)" % \
+                                         (table_name, ", ".join(index_columns))
+                        psycopg2.extras.execute_values(self.cur, delete_command, key_lists, page_size=batch_size)
+        except Exception as e:
+            print e
+            return False
+
+        return True
+
+    @_with_connection
     def get_row_insert_if_not_found(self, table_name, data):
 
+        if table_name in self.statements and self.statements[table_name].upsert:
+            return self._get_row_upsert(table_name, data)
+
         res = self.get_subset_table_rows(table_name, [data])
         if len(res) == 1:
             return res[0]
@@ -367,11 +1143,86 @@ class DB:
 
         return False
 
-    def get_joined_table_rows(self, table_name):
-        joined_tables = {}
-        for column_name in self.schema.tables[table_name].columns:
-            if self.schema.tables[table_name].columns[column_name].foreign_key:
-                fk = self.schema.tables[table_name].columns[column_name].foreign_key
-                if fk['table'] not in joined_tables:
-                    joined_tables[fk['table']] = self.get_all_table_rows(fk['table'])
-        return joined_tables
+    def _get_row_upsert(self, table_name, data):
+        # Upserts on the unique key, then returns the row as the table's select statement (with joins) shows it
+        row = self.upsert_table_row(table_name, data)
+        if not row:
+            return False
+        table = self.schema.tables[table_name]
+        if not [c for c in table.columns.values() if hasattr(c, 'foreign_key')]:
+            return row
+        key_values = self._get_key_values(table_name, self._check_data(table_name, data))
+        res = self.get_subset_table_rows(table_name, [dict(zip(table.unique_columns, key_values))])
+        if len(res) == 1:
+            return res[0]
+        return False
+
+    @_with_connection
+    def export_table(self, table_name, fileobj, file_format='csv', progress=None, fetch_size=None):
+        # Streams the table to fileobj, CSV through COPY TO STDOUT and JSON Lines through a server-side cursor.
+        # Returns the row count and throughput, which progress(stats) also receives every 10000 rows.
+        if table_name not in self.schema.tables or file_format not in dbmangler_utils.EXPORT_FORMATS:
+            return False
+
+        select_command = self.make_export_select_command(table_name)
+        transfer = dbmangler_utils.TransferProgress(table_name, progress)
+        if file_format == 'csv':
+            try:
+                self.cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER, NULL '%s')" %
+                                     (select_command, dbmangler_utils.CSV_NULL),
+                                     dbmangler_utils.CountingFile(fileobj, transfer))
+            except psycopg2.Error as e:
+                print e
+                if not self.con.transaction_depth:
+                    self.con.rollback()
+                return False
+            if not self.con.transaction_depth:
+                self.con.commit()
+            # The header line was counted as a row
+            transfer.rows -= 1
+        else:
+            chunks = self.iter_select_command(select_command, fetch_size=fetch_size, row_format='tuple',
+                                              chunked=True)
+            if chunks is False:
+                return False
+            dbmangler_utils.export_rows(fileobj, file_format, list(self.schema.tables[table_name].columns), chunks,
+                                        transfer)
+
+        return transfer.finish()
+
+    def _make_import_copy_lines(self, encoder, rows, transfer):
+        for row in rows:
+            data = encoder.encode(row)
+            if data is False:
+                transfer.add(0, 1)
+                continue
+            transfer.add(1)
+            yield '\t'.join([_make_copy_field(d) for d in data]) + '\n'
+
+    @dbmangler_utils.changes_table
+    @_with_connection
+    def import_table(self, table_name, fileobj, file_format='csv', progress=None):
+        # Loads rows written by export_table through a single COPY FROM STDIN, keeping their primary keys, then
+        # moves the serial sequences past the imported keys. As on SQLite, rows are encoded first and rows that
+        # cannot be parsed or encoded are counted as rejected, while a row the database refuses or an unreadable CSV
+        # file rolls back the whole import. The rows are streamed, so there is no batch_size.
+        if table_name not in self.schema.tables or file_format not in dbmangler_utils.EXPORT_FORMATS:
+            return False
+
+        table = self.schema.tables[table_name]
+        column_names, rows = dbmangler_utils.read_import_rows(fileobj, file_format)
+        if not dbmangler_utils.check_import_columns(table, column_names):
+            return False
+        copy_command = "COPY %s (%s) FROM STDIN" % (table_name, ", ".join(column_names))
+        encoder = dbmangler_utils.RowEncoder(table, column_names)
+        transfer = dbmangler_utils.TransferProgress(table_name, progress)
+
+        try:
+            with self.transaction():
+                self.cur.copy_expert(copy_command, IteratorFile(self._make_import_copy_lines(encoder, rows, transfer)))
+                self._reset_sequences(table_name, column_names)
+        except (psycopg2.Error, csv.Error) as e:
+            print e
+            return False
+
+        return transfer.finish()
@@ -1,7 +1,13 @@
 import dbmangler_utils
+import collections
+import contextlib
+import csv
+import functools
 import sqlite3
-import json
-import pytoml
+import threading
+
+# Key of this backend's statements in the compiled schema cache, to be changed whenever a statement builder changes
+STATEMENTS_VERSION = 'sqlite-3'
 
 
 def _dict_factory(cursor, row):
@@ -11,55 +17,220 @@ def _dict_factory(cursor, row):
     return d
 
 
-class DB:
-    def __init__(self, config_file_name='example_db_config.json'):
-        if config_file_name[-5:] == '.toml':
-            with open(config_file_name) as data_file:
-                db_config = pytoml.load(data_file)
-        else:
-            with open(config_file_name) as data_file:
-                db_config = json.load(data_file, object_hook=dbmangler_utils.decode_dict)
-        self.schema = dbmangler_utils.DBSchema(db_config)
-        self.db_name = 'default.db'
-        self.con = sqlite3.connect(self.db_name)
-        self.con.text_factory = str
-        self.con.row_factory = _dict_factory
-        self.cur = self.con.cursor()
+_row_factories = {'dict': _dict_factory, 'tuple': None, 'row': sqlite3.Row, 'record': None}
+
+
+def _iter_cursor_chunks(cur, fetch_size, record_class=None, finished=None):
+    # finished(num_rows) is called once the cursor is exhausted or the generator is closed
+    num_rows = 0
+    try:
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            num_rows += len(rows)
+            if record_class:
+                rows = [record_class(row) for row in rows]
+            yield rows
+    finally:
+        cur.close()
+        if finished:
+            finished(num_rows)
+
+
+def _iter_cursor(cur, fetch_size, record_class=None, finished=None):
+    for rows in _iter_cursor_chunks(cur, fetch_size, record_class, finished):
+        for row in rows:
+            yield row
+
+
+class DBConnection(sqlite3.Connection):
+    # Connection that carries its own shared cursor, transaction depth and the tables written in the open transaction
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.transaction_depth = 0
+        self.changed_tables = set()
+        self.cur = self.cursor()
+
+
+class DB(dbmangler_utils.DB):
+    def __init__(self, config_file_name='example_db_config.json', row_format='dict', concurrent=None):
+        dbmangler_utils.DB.__init__(self, config_file_name, row_format)
+        self.statements = dbmangler_utils.get_compiled_statements(self.schema, STATEMENTS_VERSION,
+                                                                  self.compile_statements)
+        settings = self.schema.settings.get('sqlite', {})
+        self.db_name = settings.get('db_name', 'default.db')
+        # Concurrent mode opens one connection per thread in WAL mode; writes are serialized by write_lock
+        if concurrent is None:
+            concurrent = settings.get('concurrent', False)
+        self.concurrent = concurrent
+        self.busy_timeout = settings.get('busy_timeout', 5000)
+        self.pragmas = settings.get('pragmas', {})
+        self.write_lock = threading.RLock()
+        self.local = threading.local()
+        if not self.concurrent:
+            self._con = self._connect()
+        self.fetch_size = 1000
+        if 'slow_query_ms' in settings:
+            self.enable_instrumentation(settings['slow_query_ms'])
+
+    def _connect(self):
+        # Transactions are managed explicitly by transaction(); outside of one every statement commits on its own
+        con = sqlite3.connect(self.db_name, isolation_level=None, factory=DBConnection)
+        con.text_factory = str
+        con.row_factory = _dict_factory
+        if self.concurrent:
+            con.execute('PRAGMA journal_mode = WAL')
+        con.execute('PRAGMA busy_timeout = %d' % int(self.busy_timeout))
+        for pragma in sorted(self.pragmas):
+            con.execute('PRAGMA %s = %s' % (pragma, self.pragmas[pragma]))
+        return con
+
+    @property
+    def con(self):
+        if not self.concurrent:
+            return self._con
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = self.local.con = self._connect()
+        return con
+
+    @property
+    def cur(self):
+        return self.con.cur
+
+    def _get_current_connection(self):
+        # This thread's connection, or None if it has not opened one yet
+        return self._con if not self.concurrent else getattr(self.local, 'con', None)
 
     def reset_cursor(self):
-        self.cur.close()
-        self.cur = self.con.cursor()
-
-    def run_select_command(self, command, values=None):
-        if not values:
+        self.con.cur.close()
+        self.con.cur = self.con.cursor()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # Commits when the outermost block exits and rolls back on exception; nested blocks use savepoints. The
+        # write lock is held for the whole block, so there is a single writer at a time.
+        con = self.con
+        savepoint = 'dbmangler_savepoint_%s' % con.transaction_depth
+        with self.write_lock:
+            if con.transaction_depth:
+                con.execute('SAVEPOINT %s' % savepoint)
+            elif self.concurrent:
+                con.execute('BEGIN IMMEDIATE')
+            else:
+                con.execute('BEGIN')
+            con.transaction_depth += 1
             try:
+                yield self
+            except Exception:
+                con.transaction_depth -= 1
+                if con.transaction_depth:
+                    con.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+                    con.execute('RELEASE SAVEPOINT %s' % savepoint)
+                else:
+                    con.execute('ROLLBACK')
+                    con.changed_tables.clear()
+                raise
+            con.transaction_depth -= 1
+            if con.transaction_depth:
+                con.execute('RELEASE SAVEPOINT %s' % savepoint)
+            else:
+                try:
+                    con.execute('COMMIT')
+                except sqlite3.Error:
+                    con.execute('ROLLBACK')
+                    con.changed_tables.clear()
+                    raise
+                self._tables_committed(con)
+
+    def run_select_command(self, command, values=None, row_format=None):
+        row_format = row_format or self.row_format
+        self.cur.row_factory = _row_factories[row_format]
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
+        try:
+            if not values:
                 self.cur.execute(command)
-            except sqlite3.Error as e:
-                print e
-                return False
-        else:
-            try:
+            else:
                 self.cur.execute(command, values)
-            except sqlite3.Error as e:
-                print e
-                return False
+        except sqlite3.Error as e:
+            print e
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            return False
 
-        return self.cur.fetchall()
+        rows = self.cur.fetchall()
+        if row_format == 'record':
+            record_class = self.get_record_class(self.cur.description)
+            rows = [record_class(row) for row in rows]
+        if self.instrumentation:
+            self.instrumentation.after(command, values, start, len(rows))
+
+        return rows
+
+    def iter_select_command(self, command, values=None, fetch_size=None, row_format=None, chunked=False):
+        # Runs the query on its own cursor and returns a generator that fetches fetch_size rows at a time, yielding
+        # either single rows or, if chunked is set, each fetched list of rows
+        row_format = row_format or self.row_format
+        cur = self.con.cursor()
+        cur.row_factory = _row_factories[row_format]
+        # Timed until the last row is fetched, since SQLite does most of the work while stepping through the rows
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
+        try:
+            if not values:
+                cur.execute(command)
+            else:
+                cur.execute(command, values)
+        except sqlite3.Error as e:
+            print e
+            cur.close()
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            return False
+        finished = None
+        if self.instrumentation:
+            finished = functools.partial(self.instrumentation.after, command, values, start)
+
+        record_class = None
+        if row_format == 'record':
+            record_class = self.get_record_class(cur.description)
+
+        if chunked:
+            return _iter_cursor_chunks(cur, fetch_size or self.fetch_size, record_class, finished)
+        return _iter_cursor(cur, fetch_size or self.fetch_size, record_class, finished)
 
     def run_edit_command(self, command, values):
+        start = self.instrumentation.before(command, values) if self.instrumentation else None
         try:
-            self.cur.execute(command, values)
+            with self.write_lock:
+                self.cur.execute(command, values)
         except sqlite3.Error as e:
             print e
+            if self.instrumentation:
+                self.instrumentation.after(command, values, start, error=e)
+            # Inside transaction() the error has to reach the block, so that it rolls back instead of committing
+            if self.con.transaction_depth:
+                raise
             return False
-
-        self.con.commit()
+        if self.instrumentation:
+            self.instrumentation.after(command, values, start, self.cur.rowcount)
 
         return True
 
+    def explain_command(self, command, values=None):
+        cur = self.con.cursor()
+        cur.row_factory = None
+        try:
+            cur.execute('EXPLAIN QUERY PLAN ' + command, values or [])
+            return "\n".join([str(row[-1]) for row in cur.fetchall()])
+        except sqlite3.Error as e:
+            return str(e)
+        finally:
+            cur.close()
+
     def get_db_schema(self):
-        command = "SELECT sql FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence'"
-        rows = self.run_select_command(command)  # type: list
+        command = "SELECT sql FROM sqlite_master WHERE type='table' AND name != 'sqlite_sequence' AND name != ?"
+        rows = self.run_select_command(command, [dbmangler_utils.SCHEMA_META_TABLE], row_format='dict')  # type: list
         if not rows:
             return False
         ret_list = []
@@ -99,9 +270,13 @@ class DB:
             create_tables_script += create_tables_script_line
             create_tables_array.append(create_tables_script_line[:-2])
 
+        for t in self.schema.tables:
+            for create_index_command in self.schema.tables[t].get_create_index_commands():
+                create_tables_script += create_index_command + "; "
+
         if not return_script and not return_array:
-            self.cur.executescript(create_tables_script)
-            self.con.commit()
+            with self.write_lock:
+                self.cur.executescript(create_tables_script)
 
             return True
         elif return_script:
@@ -109,81 +284,126 @@ class DB:
         elif return_array:
             return create_tables_array
 
-    def check_schema(self, create_schema=True):
-        existing_schema = self.get_db_schema()
-        correct_schema = self.create_schema(return_array=True)
-
-        if not existing_schema:
-            if create_schema:
-                print "No schema found. Creating DB schema."
-                self.create_schema()
-                return True
-            else:
-                print "No schema found."
+    def get_schema_changes(self, db_tables=None):
+        # Statements that bring the DB up to date with the schema, or False when the DB differs in a way that
+        # cannot be migrated, such as a changed column type
+        if db_tables is None:
+            db_tables = self.make_schema_object()
+            if db_tables is False:
                 return False
 
-        if len(existing_schema) < len(correct_schema):
-            print "Wrong number of tables in DB, exiting."
+        missing_tables, missing_columns, missing_indexes, problems = \
+            dbmangler_utils.diff_schema(self.schema, db_tables, lambda c: c.type[0])
+        if problems:
+            for problem in problems:
+                print problem
             return False
 
-        for s in correct_schema:
-            if s not in existing_schema:
-                print "Table definition missing or incorrect in DB, exiting."
-                return False
+        create_tables = dict(zip(self.schema.tables, self.create_schema(return_array=True)))
+        changes = [create_tables[t] for t in missing_tables]
+        for table_name, column_name in missing_columns:
+            changes.append("ALTER TABLE %s ADD COLUMN %s" %
+                           (table_name, self.make_column_definition(table_name, column_name)))
+        for table_name in missing_tables:
+            missing_indexes += [(table_name, i) for i in sorted(self.schema.tables[table_name].indexes)]
+        for table_name, index_name in missing_indexes:
+            changes.append(self.schema.tables[table_name].get_create_index_command(index_name))
+
+        return changes
+
+    def migrate_schema(self, changes):
+        # Applies the changes and stores the schema fingerprint in one transaction
+        try:
+            with self.transaction():
+                for command in changes:
+                    print "Migrating schema: %s" % command
+                    self.cur.execute(command)
+                self.cur.execute("CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value TEXT)" %
+                                 dbmangler_utils.SCHEMA_META_TABLE)
+                self.cur.execute("INSERT OR REPLACE INTO %s (key, value) VALUES ('schema_fingerprint', ?)" %
+                                 dbmangler_utils.SCHEMA_META_TABLE, [self.schema.fingerprint])
+        except sqlite3.Error as e:
+            print e
+            return False
 
+        for table_name in self.schema.tables:
+            self.table_changed(table_name)
         return True
 
-    def make_schema_object(self):
-        existing_schema = self.get_db_schema()  # type: list
-        db_tables = {}
+    def get_schema_fingerprint(self):
+        command = "SELECT name FROM sqlite_master WHERE type='table' AND name = ?"
+        if not self.run_select_command(command, [dbmangler_utils.SCHEMA_META_TABLE], row_format='tuple'):
+            return None
+        rows = self.run_select_command("SELECT value FROM %s WHERE key = 'schema_fingerprint'" %
+                                       dbmangler_utils.SCHEMA_META_TABLE, row_format='tuple')
+        if not rows:
+            return None
 
-        if not existing_schema:
+        return rows[0][0]
+
+    def make_column_definition(self, table_name, column_name):
+        column_info = self.schema.tables[table_name].columns[column_name]
+        column_definition = "%s %s" % (column_name, " ".join([t for t in column_info.type if t != 'FOREIGN KEY']))
+        if 'FOREIGN KEY' in column_info.type:
+            column_definition += " REFERENCES %s(%s)" % (column_info.foreign_key['table'], column_name)
+        return column_definition
+
+    def make_schema_object(self):
+        # Reads the tables, columns and indexes from the catalog as
+        # {table name: {'columns': [{'name', 'type', 'not_null', 'default', 'primary_key'}],
+        #               'indexes': [{'name', 'columns', 'unique'}]}}
+        command = "SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name != ?"
+        rows = self.run_select_command(command, [dbmangler_utils.SCHEMA_META_TABLE], row_format='dict')  # type: list
+        if rows is False:
             return False
 
-        for t in existing_schema:
-            split_string = t.split('(')  # type: str
-            table_name = split_string[0].replace('CREATE TABLE ', '')
-            db_tables[table_name] = {'columns': []}
-            split_column_string = split_string[1].split(',')
-            for c in split_column_string:
-                column_split = c.split(' ', 1)
-                column = {"name": column_split[0], "type": column_split[1]}
-                db_tables[table_name]['columns'].append(column)
+        db_tables = {}
+        for r in rows:
+            table_name = r['name']
+            columns = self.run_select_command("PRAGMA table_info(%s)" % table_name, row_format='dict')
+            indexes = self.run_select_command("PRAGMA index_list(%s)" % table_name, row_format='dict')
+            if columns is False or indexes is False:
+                return False
+            db_tables[table_name] = {'columns': [], 'indexes': []}
+            for c in columns:
+                db_tables[table_name]['columns'].append({'name': c['name'], 'type': c['type'],
+                                                         'not_null': bool(c['notnull']), 'default': c['dflt_value'],
+                                                         'primary_key': bool(c['pk'])})
+            for i in indexes:
+                index_columns = self.run_select_command("PRAGMA index_info(%s)" % i['name'], row_format='dict')
+                db_tables[table_name]['indexes'].append({'name': i['name'], 'unique': bool(i['unique']),
+                                                         'columns': [c['name'] for c in index_columns or []]})
 
         return db_tables
 
     def drop_db_tables(self):
-        drop_tables_script = ""
+        drop_tables_script = "DROP TABLE IF EXISTS %s;" % dbmangler_utils.SCHEMA_META_TABLE
         for t in self.schema.tables:
             drop_tables_script += "DROP TABLE IF EXISTS %s;" % t
-        self.cur.executescript(drop_tables_script)
-        self.con.commit()
+            self.table_changed(t)
+        with self.write_lock:
+            self.cur.executescript(drop_tables_script)
 
         return True
 
-    def make_sorted_list_from_dict(self, data, table_name, prefix=''):
-        ret_list = []
-        for c in self.schema.tables[table_name].columns:
-            if c not in self.schema.tables[table_name].index_columns:
-                col_label = prefix + c
-                if col_label in data:
-                    if type(data[col_label]) is str:
-                        ret_list.append(data[col_label])
-                    elif type(data[col_label]) is list:
-                        if type(data[col_label][0]) is str:
-                            ret_list.append(data[col_label][0])
-                        else:
-                            return False
-                    else:
-                        return False
-                else:
-                    return False
-        return ret_list
-
-    def make_simple_select_command(self, table_name):
-        select_command = "SELECT * FROM %s " % table_name
+    def compile_statements(self):
+        statements = {}
+        for table_name in self.schema.tables:
+            statements[table_name] = dbmangler_utils.TableStatements(
+                select=self.make_simple_select_command(table_name), insert=self.make_insert_command(table_name),
+                update=self.make_update_command(table_name), delete=self.make_delete_command(table_name),
+                upsert=self.make_upsert_command(table_name),
+                delete_by_key=self.make_delete_by_key_command(table_name))
+        return statements
+
+    def make_simple_select_command(self, table_name, columns=None, additional_joins=None):
+        # Projects the given base table columns, or all of them, and the included columns of the joined tables
         if table_name not in self.schema.tables:
             return False
+        select_list = dbmangler_utils.make_select_list(self.schema, table_name, columns, additional_joins)
+        if not select_list:
+            return False
+        select_command = "SELECT %s FROM %s " % (select_list, table_name)
         for column_name in self.schema.tables[table_name].columns:
             column_info = self.schema.tables[table_name].columns[column_name]
             if 'FOREIGN KEY' in column_info.type:
@@ -192,8 +412,8 @@ class DB:
                      column_name)
         return select_command
 
-    def make_complex_select_command(self, table_name, additional_joins):
-        select_command = self.make_simple_select_command(table_name)
+    def make_complex_select_command(self, table_name, additional_joins, columns=None):
+        select_command = self.make_simple_select_command(table_name, columns, additional_joins)
         if not select_command:
             return False
         for j in additional_joins:
@@ -212,6 +432,11 @@ class DB:
         insert_command += ")"
         return insert_command
 
+    def make_upsert_command(self, table_name):
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].unique_columns:
+            return False
+        return self.make_insert_command(table_name).replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+
     def make_update_command(self, table_name):
         update_command = "UPDATE %s SET " % table_name
         first_entry = True
@@ -236,6 +461,23 @@ class DB:
 
         return update_command
 
+    def make_key_where_clause(self, table_name):
+        return " AND ".join(["%s=?" % c for c in self.schema.tables[table_name].index_columns])
+
+    def make_delete_by_key_command(self, table_name):
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].index_columns:
+            return False
+        delete_command = "DELETE FROM %s WHERE %s" % (table_name, self.make_key_where_clause(table_name))
+        return delete_command
+
+    def make_update_by_key_command(self, table_name, column_names):
+        if table_name not in self.schema.tables or not self.schema.tables[table_name].index_columns:
+            return False
+        update_command = "UPDATE %s SET %s WHERE %s" % \
+                         (table_name, ", ".join(["%s=?" % c for c in column_names]),
+                          self.make_key_where_clause(table_name))
+        return update_command
+
     def make_delete_command(self, table_name):
         delete_command = "DELETE FROM %s WHERE " % table_name
         first_entry = True
@@ -251,76 +493,175 @@ class DB:
 
         return delete_command
 
-    def get_subset_table_rows(self, table_name, conditions, additional_joins=None, order_and_limit=None):
-
-        if not additional_joins:
-            select_command = self.make_simple_select_command(table_name)
-        else:
-            select_command = self.make_complex_select_command(table_name, additional_joins)
-        first_item = True
-        for c in conditions:
-            if first_item:
-                first_item = False
-                select_command += 'WHERE '
-            else:
-                select_command += 'AND '
-            if type(c[c.keys()[0]]) is list:
-                select_command += "%s = '%s' " % (c.keys()[0], c[c.keys()[0]][0])
-            elif type(c[c.keys()[0]]) is str or type(c[c.keys()[0]]) is int:
-                select_command += "%s = '%s' " % (c.keys()[0], c[c.keys()[0]])
-
-        if order_and_limit:
-            if 'order' in order_and_limit.keys():
-                first_item = True
-                for o in order_and_limit['order']:
-                    if first_item:
-                        first_item = False
-                        select_command += 'ORDER BY '
-                    else:
-                        select_command += ', '
-                    select_command += '%s ' % o
-            if 'limit' in order_and_limit.keys():
-                select_command += 'LIMIT %s ' % order_and_limit['limit']
-
-        return self.run_select_command(select_command)
+    def run_cached_select_command(self, command, values, tables):
+        # Serves the query from the query cache, when enabled, as long as none of the tables it reads has changed.
+        # Inside a transaction the cache is bypassed, since the rows read there may be rolled back.
+
+        query_cache = self.query_cache if not self.in_transaction() else None
+        if query_cache:
+            cache_key = query_cache.make_key(self.row_format, command, values)
+            rows = query_cache.get(cache_key)
+            if rows is not None:
+                return rows
+            versions = query_cache.get_versions(tables)
+
+        rows = self.iter_select_command(command, values)
+        if rows is False:
+            return False
+        rows = list(rows)
+        if query_cache:
+            return query_cache.put(cache_key, versions, rows)
+
+        return rows
 
     def get_all_table_rows(self, table_name):
 
-        select_command = self.make_simple_select_command(table_name)
+        if table_name not in self.statements:
+            return False
 
-        return self.run_select_command(select_command)
+        return self.run_cached_select_command(self.statements[table_name].select, None,
+                                              self.get_select_dependencies(table_name))
 
-    def _check_data(self, table_name, data):
+    @dbmangler_utils.changes_table
+    def add_table_row(self, table_name, data):
 
-        if table_name not in self.schema.tables:
+        data = self._check_data(table_name, data)
+
+        if not data:
             return False
 
-        if len(data) < self.schema.tables[table_name].get_num_columns(exclude_index=True):
-            print 'ERROR: number of columns and items in data do not match'
+        insert_command = self.statements[table_name].insert
+
+        if not self.run_edit_command(insert_command, data):
             return False
 
-        if type(data) is dict:
-            data = self.make_sorted_list_from_dict(data, table_name)
-            if not data:
-                print 'ERROR: could not make list from data dict'
-                return False
+        if self.schema.tables[table_name].row_id_column:
+            return self.cur.lastrowid
 
-        return data
+        return True
 
-    def add_table_row(self, table_name, data):
+    def _get_key_values(self, table_name, data):
+        column_names = self.schema.tables[table_name].get_column_names(exclude_index=True)
+        return [data[column_names.index(c)] for c in self.schema.tables[table_name].unique_columns]
+
+    @dbmangler_utils.changes_table
+    def upsert_table_row(self, table_name, data):
+        # Inserts the row unless a row with the same unique key already exists, and returns the stored row either way
 
         data = self._check_data(table_name, data)
 
         if not data:
             return False
 
-        insert_command = self.make_insert_command(table_name)
+        table = self.schema.tables[table_name]
+        if not self.statements[table_name].upsert:
+            print 'ERROR: table %s has no unique columns' % table_name
+            return False
 
-        if not self.run_edit_command(insert_command, data):
+        try:
+            with self.transaction():
+                self.cur.execute(self.statements[table_name].upsert, data)
+                if self.cur.rowcount == 1 and table.row_id_column:
+                    select_command = "SELECT * FROM %s WHERE %s = ?" % (table_name, table.row_id_column)
+                    values = [self.cur.lastrowid]
+                else:
+                    select_command = "SELECT * FROM %s WHERE %s" % \
+                                     (table_name, dbmangler_utils.make_key_in_clause(table.unique_columns, 1))
+                    values = self._get_key_values(table_name, data)
+                rows = self.run_select_command(select_command, values)
+        except sqlite3.Error as e:
+            print e
+            return False
+
+        if not rows:
+            return False
+
+        return rows[0]
+
+    @dbmangler_utils.changes_table
+    def get_row_ids(self, table_name, rows, batch_size=500):
+        # Resolves the unique key of every row to its primary key, inserting the rows that do not exist yet. Returns a
+        # dict of key (a single value, or a tuple for composite keys) to primary key.
+        if table_name not in self.schema.tables:
+            return False
+
+        table = self.schema.tables[table_name]
+        if not self.statements[table_name].upsert or len(table.index_columns) != 1:
+            print 'ERROR: table %s needs unique columns and a single primary key' % table_name
+            return False
+
+        row_ids = {}
+        for batch in dbmangler_utils.chunk_iterable(rows, batch_size):
+            batch_data = self.schema.encoders[table_name].encode_many(batch)[0]
+            if not batch_data:
+                continue
+            keys = list(set([tuple(self._get_key_values(table_name, d)) for d in batch_data]))
+            select_command = "SELECT %s, %s FROM %s WHERE %s" % \
+                             (table.index_columns[0], ", ".join(table.unique_columns), table_name,
+                              dbmangler_utils.make_key_in_clause(table.unique_columns, len(keys)))
+            try:
+                with self.transaction():
+                    self.cur.executemany(self.statements[table_name].upsert, batch_data)
+                    found_rows = self.run_select_command(select_command, [v for k in keys for v in k],
+                                                         row_format='tuple')
+            except sqlite3.Error as e:
+                print e
+                return False
+            if found_rows is False:
+                return False
+            for row in found_rows:
+                if len(row) == 2:
+                    row_ids[row[1]] = row[0]
+                else:
+                    row_ids[tuple(row[1:])] = row[0]
+
+        return row_ids
+
+    @dbmangler_utils.changes_table
+    def add_table_rows(self, table_name, rows, batch_size=1000):
+        # Each batch is written with one executemany in one transaction; a failed batch is rolled back and reported
+        if table_name not in self.schema.tables:
+            return False
+
+        insert_command = self.statements[table_name].insert
+        results = {'rows_added': 0, 'rows_rejected': 0, 'failed_batches': []}
+
+        for batch_number, batch in enumerate(dbmangler_utils.chunk_iterable(rows, batch_size)):
+            batch_data, num_rejected = self.schema.encoders[table_name].encode_many(batch)
+            results['rows_rejected'] += num_rejected
+            if not batch_data:
+                continue
+            try:
+                with self.transaction():
+                    self.cur.executemany(insert_command, batch_data)
+            except sqlite3.Error as e:
+                print 'ERROR: batch %s failed: %s' % (batch_number, e)
+                results['failed_batches'].append((batch_number, str(e)))
+                continue
+            results['rows_added'] += len(batch_data)
+
+        return results
+
+    @dbmangler_utils.changes_table
+    def add_encoded_rows(self, table_name, column_names, batch_data):
+        # Writes rows already encoded for column_names, e.g. by a RowEncoder in another process, with one
+        # executemany in one transaction
+        if table_name not in self.schema.tables:
+            return False
+
+        insert_command = "INSERT INTO %s (%s) VALUES(%s)" % \
+                         (table_name, ", ".join(column_names),
+                          dbmangler_utils.make_list_string_from_char('?', len(column_names)))
+        try:
+            with self.transaction():
+                self.cur.executemany(insert_command, batch_data)
+        except sqlite3.Error as e:
+            print e
             return False
 
         return True
 
+    @dbmangler_utils.changes_table
     def delete_table_row(self, table_name, data):
 
         data = self._check_data(table_name, data)
@@ -328,13 +669,14 @@ class DB:
         if not data:
             return False
 
-        delete_command = self.make_delete_command(table_name)
+        delete_command = self.statements[table_name].delete
 
         if not self.run_edit_command(delete_command, data):
             return False
 
         return True
 
+    @dbmangler_utils.changes_table
     def update_table_row(self, table_name, old_data, new_data):
 
         new_data_list = self._check_data(table_name, new_data)
@@ -343,15 +685,88 @@ class DB:
             return False
         data = new_data_list+old_data_list  # type: list
 
-        update_command = self.make_update_command(table_name)
+        update_command = self.statements[table_name].update
 
         if not self.run_edit_command(update_command, data):
             return False
 
         return True
 
+    @dbmangler_utils.changes_table
+    def update_row_by_key(self, table_name, key, changes):
+        # Updates only the changed columns of the row with the given primary key
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        row = dict(changes)
+        row.update(zip(self.schema.tables[table_name].index_columns, self._get_key_list(table_name, key)))
+        key_row = self._split_key_row(table_name, row)
+        if not key_row or not key_row[0]:
+            return False
+
+        return self.run_edit_command(self._get_update_by_key_command(table_name, key_row[0]), key_row[1])
+
+    @dbmangler_utils.changes_table
+    def update_rows_by_key(self, table_name, rows):
+        # Each row is a dict of the primary key plus the changed columns. Rows changing the same columns are sent
+        # together, and all of them are written in one transaction.
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        grouped_rows = collections.OrderedDict()
+        for row in rows:
+            key_row = self._split_key_row(table_name, row)
+            if not key_row or not key_row[0]:
+                return False
+            grouped_rows.setdefault(key_row[0], []).append(key_row[1])
+
+        try:
+            with self.transaction():
+                for column_names in grouped_rows:
+                    update_command = self._get_update_by_key_command(table_name, column_names)
+                    self.cur.executemany(update_command, grouped_rows[column_names])
+        except sqlite3.Error as e:
+            print e
+            return False
+
+        return True
+
+    @dbmangler_utils.changes_table
+    def delete_row_by_key(self, table_name, key):
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        return self.run_edit_command(self.statements[table_name].delete_by_key, self._get_key_list(table_name, key))
+
+    @dbmangler_utils.changes_table
+    def delete_rows_by_key(self, table_name, keys, batch_size=500):
+        # Deletes many rows by primary key with one statement per batch, all in one transaction
+
+        if table_name not in self.statements or not self.statements[table_name].delete_by_key:
+            return False
+
+        index_columns = self.schema.tables[table_name].index_columns
+        try:
+            with self.transaction():
+                for batch in dbmangler_utils.chunk_iterable(keys, batch_size):
+                    key_lists = [self._get_key_list(table_name, k) for k in batch]
+                    delete_command = "DELETE FROM %s WHERE %s" % \
+                                     (table_name, dbmangler_utils.make_key_in_clause(index_columns, len(key_lists)))
+                    self.cur.execute(delete_command, [v for k in key_lists for v in k])
+        except sqlite3.Error as e:
+            print e
+            return False
+
+        return True
+
     def get_row_insert_if_not_found(self, table_name, data):
 
+        if table_name in self.statements and self.statements[table_name].upsert:
+            return self._get_row_upsert(table_name, data)
+
         res = self.get_subset_table_rows(table_name, [data])
         if len(res) == 1:
             return res[0]
@@ -365,11 +780,62 @@ class DB:
 
         return False
 
-    def get_joined_table_rows(self, table_name):
-        joined_tables = {}
-        for column_name in self.schema.tables[table_name].columns:
-            if self.schema.tables[table_name].columns[column_name].foreign_key:
-                fk = self.schema.tables[table_name].columns[column_name].foreign_key
-                if fk['table'] not in joined_tables:
-                    joined_tables[fk['table']] = self.get_all_table_rows(fk['table'])
-        return joined_tables
+    def _get_row_upsert(self, table_name, data):
+        # Upserts on the unique key, then returns the row as the table's select statement (with joins) shows it
+        row = self.upsert_table_row(table_name, data)
+        if not row:
+            return False
+        table = self.schema.tables[table_name]
+        if not [c for c in table.columns.values() if hasattr(c, 'foreign_key')]:
+            return row
+        key_values = self._get_key_values(table_name, self._check_data(table_name, data))
+        res = self.get_subset_table_rows(table_name, [dict(zip(table.unique_columns, key_values))])
+        if len(res) == 1:
+            return res[0]
+        return False
+
+    def export_table(self, table_name, fileobj, file_format='csv', progress=None, fetch_size=None):
+        # Streams the table to fileobj as CSV or JSON Lines through a bounded cursor. Returns the row count and
+        # throughput, which progress(stats) also receives every 10000 rows.
+        if table_name not in self.schema.tables or file_format not in dbmangler_utils.EXPORT_FORMATS:
+            return False
+
+        chunks = self.iter_select_command(self.make_export_select_command(table_name), fetch_size=fetch_size,
+                                          row_format='tuple', chunked=True)
+        if chunks is False:
+            return False
+        transfer = dbmangler_utils.TransferProgress(table_name, progress)
+        dbmangler_utils.export_rows(fileobj, file_format, list(self.schema.tables[table_name].columns), chunks,
+                                    transfer)
+
+        return transfer.finish()
+
+    @dbmangler_utils.changes_table
+    def import_table(self, table_name, fileobj, file_format='csv', progress=None, batch_size=1000):
+        # Loads rows written by export_table, keeping their primary keys, in one transaction. Rows that cannot be
+        # parsed or encoded are counted as rejected; a failing insert or an unreadable CSV file rolls back the whole
+        # import.
+        if table_name not in self.schema.tables or file_format not in dbmangler_utils.EXPORT_FORMATS:
+            return False
+
+        table = self.schema.tables[table_name]
+        column_names, rows = dbmangler_utils.read_import_rows(fileobj, file_format)
+        if not dbmangler_utils.check_import_columns(table, column_names):
+            return False
+        encoder = dbmangler_utils.RowEncoder(table, column_names)
+        insert_command = "INSERT INTO %s (%s) VALUES(%s)" % \
+                         (table_name, ", ".join(column_names),
+                          dbmangler_utils.make_list_string_from_char('?', len(column_names)))
+        transfer = dbmangler_utils.TransferProgress(table_name, progress)
+
+        try:
+            with self.transaction():
+                for batch in dbmangler_utils.chunk_iterable(rows, batch_size):
+                    batch_data, num_rejected = encoder.encode_many(batch)
+                    self.cur.executemany(insert_command, batch_data)
+                    transfer.add(len(batch_data), num_rejected)
+        except (sqlite3.Error, csv.Error) as e:
+            print e
+            return False
+
+        return transfer.finish()